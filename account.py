@@ -0,0 +1,87 @@
+import logging
+import time
+
+from types import MappingProxyType
+
+import ccxt
+
+log = logging.getLogger(__name__)
+
+
+def freeze(value):
+    # Read-only copy so one consumer can't change what the next one sees
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class AccountSnapshot:
+    # Positions, swap balance and open orders as they were at one moment.
+    # open_orders(symbol) is None for symbols whose orders were never fetched,
+    # so callers can tell "no orders" from "don't know".
+    def __init__(self, positions, balance=None, orders=None, taken_at=None):
+        self.positions = freeze(list(positions))
+        self.balance = freeze(balance) if balance is not None else None
+        self.orders = {symbol: freeze(list(o)) for symbol, o in (orders or {}).items() if o is not None}
+        self.taken_at = taken_at if taken_at is not None else time.time()
+
+    def open_orders(self, symbol):
+        return self.orders.get(symbol)
+
+    def free(self, currency='USDT'):
+        return (self.balance or {}).get(currency, {}).get('free', 0)
+
+    def total(self, currency='USDT'):
+        return (self.balance or {}).get(currency, {}).get('total', 0)
+
+    def open_positions(self):
+        return [p for p in self.positions if float(p.get('contracts') or 0) > 0]
+
+    def positions_map(self):
+        # symbol -> {'has_position', 'side'}, the shape cancel_orphan_orders works with
+        result = {}
+        for p in self.positions:
+            contracts = float(p.get('contracts') or p.get('size') or 0)
+            if contracts > 0 or p['symbol'] not in result:
+                result[p['symbol']] = {
+                    'has_position': contracts > 0,
+                    'side': (p.get('side') or '').lower(),
+                }
+        return result
+
+
+# Exchanges that turned down a symbol-less fetch_open_orders; they're not asked that way again
+_needs_symbol = set()
+
+
+def fetch_all_open_orders(exchange, symbols):
+    # One symbol-less call where the exchange allows it. Phemex insists on a
+    # symbol, so there we fall back to one call per symbol we actually need.
+    orders = {symbol: [] for symbol in symbols}
+    if exchange.id not in _needs_symbol:
+        try:
+            for o in exchange.fetch_open_orders():
+                orders.setdefault(o['symbol'], []).append(o)
+            return orders
+        except ccxt.ArgumentsRequired:
+            _needs_symbol.add(exchange.id)
+    for symbol in symbols:
+        try:
+            orders[symbol] = exchange.fetch_open_orders(symbol)
+        except Exception as e:
+            log.warning("⚠️ Failed to fetch open orders for %s: %s", symbol, e)
+            orders[symbol] = None
+    return orders
+
+
+def take_snapshot(exchange, symbols, order_symbols=()):
+    # order_symbols: extra symbols whose orders matter even without a position
+    taken_at = time.time()
+    positions = exchange.fetch_positions(symbols=symbols)
+    balance = exchange.fetch_balance({'type': 'swap'})
+    wanted = {p['symbol'] for p in positions if float(p.get('contracts') or 0) > 0}
+    wanted.update(order_symbols)
+    orders = fetch_all_open_orders(exchange, sorted(wanted))
+    return AccountSnapshot(positions, balance, orders, taken_at)
@@ -0,0 +1,105 @@
+import contextvars
+import json
+import logging
+import os
+
+from contextlib import contextmanager
+
+from journal import Journal
+from position_mode import PositionModeResolver
+from reconciler import OrderReconciler
+from triggers import TriggerEngine
+
+_current = contextvars.ContextVar('account', default=None)
+_default = None
+
+
+class Account:
+    # Everything that belongs to one trading account: its exchange connection
+    # (with its own rate budget), trailing state, position modes, order index,
+    # local stop triggers, trade journal and the positions its last tick had to
+    # defer. Market metadata, the scheduler and the worker pools are shared
+    # between accounts.
+    def __init__(self, name, exchange, trailing_store, credentials=None, exchange_id='phemex', journal=None):
+        self.name = name
+        self.exchange = exchange
+        self.trailing_store = trailing_store
+        self.credentials = credentials or {}
+        self.exchange_id = exchange_id
+        self.position_modes = PositionModeResolver()
+        self.order_index = OrderReconciler()
+        self.deferred_symbols = set()
+        self.triggers = TriggerEngine()
+        self.journal = journal if journal is not None else Journal(':memory:')
+        # Set in stream mode, so the orders we place show up in its books straight away
+        self.stream_engine = None
+
+    def __repr__(self):
+        return f"Account({self.name!r}, {self.exchange_id})"
+
+
+def current():
+    # The account the running code works for; falls back to the single-account default
+    return _current.get() or _default
+
+
+def set_default(account):
+    global _default
+    _default = account
+
+
+@contextmanager
+def use(account):
+    token = _current.set(account)
+    try:
+        yield account
+    finally:
+        _current.reset(token)
+
+
+def run_as(account, fn, *args, **kwargs):
+    # Thread / job entry point that works for one account
+    with use(account):
+        return fn(*args, **kwargs)
+
+
+class AccountFilter(logging.Filter):
+    # Tags every record with the account it was logged for. Sits on the
+    # queue handler, so it runs in the caller's thread and context.
+    def filter(self, record):
+        account = current()
+        record.account = account.name if account is not None else '-'
+        return True
+
+
+def load_account_configs(path):
+    # JSON list of accounts, e.g.
+    #   [{"name": "main", "api_key_env": "API_KEY", "secret_env": "SECRET"},
+    #    {"name": "sub1", "exchange": "phemex", "api_key_env": "SUB1_API_KEY",
+    #     "secret_env": "SUB1_SECRET", "trailing_db": "sub1.db", "journal_db": "sub1-journal.db",
+    #     "options": {}}]
+    # Keys can also be given inline as apiKey / secret.
+    with open(path) as f:
+        entries = json.load(f)
+    configs = []
+    names = set()
+    for entry in entries:
+        name = entry['name']
+        if name in names:
+            raise ValueError(f"Account {name} is listed twice in {path}")
+        names.add(name)
+        credentials = {
+            'apiKey': entry.get('apiKey') or os.getenv(entry.get('api_key_env', '')),
+            'secret': entry.get('secret') or os.getenv(entry.get('secret_env', '')),
+        }
+        if entry.get('password_env') or entry.get('password'):
+            credentials['password'] = entry.get('password') or os.getenv(entry['password_env'])
+        configs.append({
+            'name': name,
+            'exchange': entry.get('exchange', 'phemex'),
+            'credentials': credentials,
+            'options': entry.get('options', {}),
+            'trailing_db': entry.get('trailing_db', f"trailing-{name}.db"),
+            'journal_db': entry.get('journal_db', f"journal-{name}.db"),
+        })
+    return configs
@@ -0,0 +1,448 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+# The bot must never touch the live trailing state from a backtest
+os.environ['TRAILING_DB'] = ':memory:'
+os.environ['JOURNAL_DB'] = ':memory:'
+
+import ccxt
+import numpy as np
+
+import accounts
+import main
+from accounts import Account
+from trailing_store import TrailingStore
+
+# Thousands of simulated ticks; the bot's own log lines would drown the report
+logging.disable(logging.CRITICAL)
+
+
+class SimExchange:
+    # Just enough of the ccxt exchange surface for the bot to run against
+    # recorded or synthetic bars. One-way mode, isolated margin, one position
+    # per symbol. step() walks each bar open -> low/high -> close and fills
+    # stops, limits and liquidations in the order the price reaches them.
+    id = 'sim'
+    rateLimit = 0
+
+    def __init__(self, symbols, balance=1000.0, leverage=10, taker_fee=0.0006, maker_fee=0.0001,
+                 maintenance_margin=0.005, tick_size=0.0001, lot_size=0.001):
+        self.has = {'editOrder': True, 'cancelOrders': False, 'fetchOpenOrders': True}
+        self.markets = {
+            symbol: {
+                'symbol': symbol,
+                'id': symbol.replace('/', '').split(':')[0],
+                'type': 'swap',
+                'swap': True,
+                'linear': True,
+                'settle': 'USDT',
+                'contractSize': 1,
+                'active': True,
+                'precision': {'price': tick_size, 'amount': lot_size},
+                'limits': {},
+            }
+            for symbol in symbols
+        }
+        self.cash = balance
+        self.leverage = leverage
+        self.taker_fee = taker_fee
+        self.maker_fee = maker_fee
+        self.maintenance_margin = maintenance_margin
+        self.positions = {}
+        self.orders = {}
+        self.marks = {}
+        self.ids = itertools.count(1)
+        self.stats = {
+            'entries': 0, 'stop_hits': 0, 'stop_pnl': 0.0, 'reentries': 0,
+            'liquidations': 0, 'rejected': 0, 'calls': 0, 'fees': 0.0,
+        }
+
+    # --- ccxt surface ---
+
+    def load_markets(self, reload=False):
+        return self.markets
+
+    def fetch_positions(self, symbols=None, params={}):
+        self.stats['calls'] += 1
+        return [self._position_view(s) for s in self.positions if symbols is None or s in symbols]
+
+    def fetch_balance(self, params={}):
+        self.stats['calls'] += 1
+        used = sum(p['margin'] for p in self.positions.values())
+        return {'USDT': {'free': self.cash, 'used': used, 'total': self.equity()}}
+
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        self.stats['calls'] += 1
+        return [dict(o) for o in self.orders.values() if symbol is None or o['symbol'] == symbol]
+
+    fetchOpenOrders = fetch_open_orders
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self.stats['calls'] += 1
+        order = {
+            'id': str(next(self.ids)),
+            'symbol': symbol,
+            'type': type,
+            'side': side,
+            'amount': float(amount),
+            'price': price,
+            'stopPrice': params.get('stopPx'),
+            'reduceOnly': bool(params.get('reduceOnly')),
+            'status': 'open',
+            'info': {'posSide': params.get('posSide', 'Merged')},
+        }
+        mark = self.marks.get(symbol)
+        if type == 'market':
+            self._fill(order, mark, self.taker_fee)
+            return dict(order, status='closed')
+        self.orders[order['id']] = order
+        # A stop already on the wrong side of the market goes off straight away
+        if type == 'stop' and mark is not None and self._stop_hit(order, mark):
+            self._trigger(order['id'], mark)
+        return dict(order)
+
+    def cancel_order(self, id, symbol=None, params={}):
+        self.stats['calls'] += 1
+        order = self.orders.pop(id, None)
+        if order is None:
+            raise ccxt.OrderNotFound(f"sim order {id} not found")
+        return dict(order, status='canceled')
+
+    def edit_order(self, id, symbol, type, side, amount=None, price=None, params={}):
+        self.stats['calls'] += 1
+        order = self.orders.get(id)
+        if order is None:
+            raise ccxt.OrderNotFound(f"sim order {id} not found")
+        if amount is not None:
+            order['amount'] = float(amount)
+        if price is not None:
+            order['price'] = price
+        if params.get('stopPx') is not None:
+            order['stopPrice'] = params['stopPx']
+        mark = self.marks.get(symbol)
+        if order['type'] == 'stop' and mark is not None and self._stop_hit(order, mark):
+            self._trigger(id, mark)
+        return dict(order)
+
+    # --- simulation ---
+
+    def open_position(self, symbol, side, notional):
+        price = self.marks[symbol]
+        order = {'symbol': symbol, 'side': 'buy' if side == 'long' else 'sell', 'amount': notional / price, 'reduceOnly': False}
+        if self._fill(order, price, self.taker_fee) is not None:
+            self.stats['entries'] += 1
+
+    def equity(self):
+        total = self.cash
+        for symbol, p in self.positions.items():
+            sign = 1 if p['side'] == 'long' else -1
+            total += p['margin'] + sign * (self.marks[symbol] - p['entry']) * p['contracts']
+        return total
+
+    def step(self, symbol, bar):
+        o, h, l, c = bar
+        if symbol not in self.marks:
+            self.marks[symbol] = o
+        path = [o, l, h, c] if c >= o else [o, h, l, c]
+        for start, end in zip(path, path[1:]):
+            self._walk(symbol, start, end)
+        self.marks[symbol] = c
+
+    def _walk(self, symbol, start, end):
+        # Fill whatever the price reaches between start and end, nearest first
+        while True:
+            hit = None
+            for level, kind, ref in self._levels(symbol, start, end):
+                if hit is None or abs(level - start) < abs(hit[0] - start):
+                    hit = (level, kind, ref)
+            if hit is None:
+                return
+            level, kind, ref = hit
+            self.marks[symbol] = level
+            if kind == 'liquidation':
+                self._liquidate(symbol)
+            else:
+                self._trigger(ref, level)
+            start = level
+
+    def _levels(self, symbol, start, end):
+        low, high = min(start, end), max(start, end)
+        down = end < start
+        pos = self.positions.get(symbol)
+        if pos is not None:
+            liq = pos['liquidation']
+            if low <= liq <= high and (pos['side'] == 'long') == down:
+                yield liq, 'liquidation', None
+        for order in self.orders.values():
+            if order['symbol'] != symbol:
+                continue
+            level = order['stopPrice'] if order['type'] == 'stop' else order['price']
+            if level is None or not (low <= level <= high):
+                continue
+            # Sell stops and buy limits wait for the price to come down, the rest for it to go up
+            wants_down = (order['type'] == 'stop') == (order['side'] == 'sell')
+            if wants_down == down:
+                yield level, 'order', order['id']
+
+    def _stop_hit(self, order, price):
+        return price <= order['stopPrice'] if order['side'] == 'sell' else price >= order['stopPrice']
+
+    def _trigger(self, order_id, price):
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return
+        if order['type'] == 'stop':
+            pnl = self._fill(order, price, self.taker_fee)
+            if pnl is not None:
+                self.stats['stop_hits'] += 1
+                self.stats['stop_pnl'] += pnl
+        elif self._fill(order, price, self.maker_fee) is not None:
+            self.stats['reentries'] += 1
+
+    def _fill(self, order, price, fee_rate):
+        # Returns the realized PnL of the fill (0 for opening fills), None if nothing happened
+        symbol = order['symbol']
+        side = 'long' if order['side'] == 'buy' else 'short'
+        pos = self.positions.get(symbol)
+        fee = order['amount'] * price * fee_rate
+
+        if pos is not None and pos['side'] != side:
+            qty = min(order['amount'], pos['contracts'])
+            sign = 1 if pos['side'] == 'long' else -1
+            pnl = sign * (price - pos['entry']) * qty
+            released = pos['margin'] * qty / pos['contracts']
+            fee = qty * price * fee_rate
+            self.cash += released + pnl - fee
+            self.stats['fees'] += fee
+            pos['margin'] -= released
+            pos['contracts'] -= qty
+            pos['realized'] += pnl - fee
+            if pos['contracts'] <= 1e-12:
+                self._close(symbol)
+            return pnl - fee
+
+        if order.get('reduceOnly'):
+            return None
+        margin = order['amount'] * price / self.leverage
+        if margin + fee > self.cash:
+            self.stats['rejected'] += 1
+            return None
+        self.cash -= margin + fee
+        self.stats['fees'] += fee
+        if pos is None:
+            pos = self.positions[symbol] = {'side': side, 'contracts': 0.0, 'entry': price, 'margin': 0.0, 'realized': 0.0}
+        total = pos['contracts'] + order['amount']
+        pos['entry'] = (pos['entry'] * pos['contracts'] + price * order['amount']) / total
+        pos['contracts'] = total
+        pos['margin'] += margin
+        pos['realized'] -= fee
+        sign = 1 if side == 'long' else -1
+        pos['liquidation'] = pos['entry'] * (1 - sign * (1 / self.leverage - self.maintenance_margin))
+        return 0.0
+
+    def _liquidate(self, symbol):
+        self.stats['liquidations'] += 1
+        # Isolated margin: the margin is gone, nothing comes back
+        self._close(symbol)
+
+    def _close(self, symbol):
+        self.positions.pop(symbol, None)
+        # Stops close with the position; leftover re-entries are what cleanup would cancel
+        for order_id in [i for i, o in self.orders.items() if o['symbol'] == symbol]:
+            del self.orders[order_id]
+
+    def _position_view(self, symbol):
+        p = self.positions[symbol]
+        mark = self.marks[symbol]
+        return {
+            'symbol': symbol,
+            'side': p['side'],
+            'contracts': p['contracts'],
+            'entryPrice': p['entry'],
+            'markPrice': mark,
+            'liquidationPrice': p['liquidation'],
+            'leverage': self.leverage,
+            'notional': p['contracts'] * mark,
+            'info': {'curTermRealisedPnlRv': str(p['realized']), 'posSide': 'Merged'},
+        }
+
+
+# --- price series ---
+
+def synthetic_bars(count, volatility=0.01, drift=0.0, start=100.0, seed=0, steps=8):
+    # Geometric Brownian motion, each bar built from a few sub-steps for high/low
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(drift / steps, volatility / math.sqrt(steps), size=(count, steps))
+    paths = start * np.exp(np.cumsum(returns.ravel())).reshape(count, steps)
+    opens = np.concatenate(([start], paths[:-1, -1]))
+    highs = np.maximum(paths.max(axis=1), opens)
+    lows = np.minimum(paths.min(axis=1), opens)
+    return [tuple(map(float, row)) for row in zip(opens, highs, lows, paths[:, -1])]
+
+
+def load_csv_bars(path):
+    # timestamp,open,high,low,close[,volume] as written by ccxt fetch_ohlcv dumps
+    bars = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            try:
+                bars.append(tuple(float(v) for v in row[1:5]))
+            except (ValueError, IndexError):
+                continue  # header or junk line
+    return bars
+
+
+def fetch_bars(symbol, timeframe, limit):
+    exchange = ccxt.phemex({'enableRateLimit': True})
+    return [tuple(float(v) for v in candle[1:5]) for candle in exchange.fetch_ohlcv(symbol, timeframe, limit=limit)]
+
+
+# --- runs ---
+
+SYMBOL = 'SIM/USDT:USDT'
+series_by_seed = []
+
+
+def init_worker(series):
+    global series_by_seed
+    series_by_seed = series
+
+
+def run_backtest(params, bars):
+    # One run of the bot over one series with one parameter set
+    main.DEFAULT_TRAILING = {'threshold': params['threshold'], 'profit_target_distance': params['target']}
+    main.REENTRY_FRACTION = params['reentry_fraction']
+    main.REENTRY_NOTIONAL_MULTIPLIER = params['reentry_mult']
+    main.TRAIL_MODE = params['trail_mode']
+    main.TRAIL_DISTANCE = params['trail_distance']
+    sim = SimExchange([SYMBOL], balance=params['balance'], leverage=params['leverage'])
+    account = Account('backtest', sim, TrailingStore(':memory:'), exchange_id=sim.id)
+    accounts.set_default(account)
+    main.market_caches.clear()
+    main.candle_caches.clear()
+    peak = params['balance']
+    max_drawdown = 0.0
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.closing(account.trailing_store), \
+            contextlib.closing(account.journal):
+        for bar in bars:
+            sim.step(SYMBOL, bar)
+            if SYMBOL not in sim.positions:
+                sim.open_position(SYMBOL, params['side'], params['stake'])
+            for pos in sim.fetch_positions():
+                # The strategy only steps by breath_threshold; its breath_stop argument is unused
+                main.trailing_stop_logic(sim, pos, params['breath_threshold'], params['breath_threshold'])
+                if pos['contracts'] > 0 and pos['symbol'] in sim.positions:
+                    main.monitor_position_and_reenter(sim, pos['symbol'], sim._position_view(pos['symbol']))
+            equity = sim.equity()
+            peak = max(peak, equity)
+            max_drawdown = max(max_drawdown, (peak - equity) / peak if peak else 0.0)
+
+    stats = sim.stats
+    return {
+        'pnl': sim.equity() - params['balance'],
+        'max_drawdown': max_drawdown,
+        'stop_hits': stats['stop_hits'],
+        'avg_stop_pnl': stats['stop_pnl'] / stats['stop_hits'] if stats['stop_hits'] else 0.0,
+        'reentries': stats['reentries'],
+        'liquidations': stats['liquidations'],
+        'entries': stats['entries'],
+        'fees': stats['fees'],
+        'calls': stats['calls'],
+    }
+
+
+def run_combo(params):
+    # Same parameters over every series, averaged
+    runs = [run_backtest(params, bars) for bars in series_by_seed]
+    summary = {key: sum(r[key] for r in runs) / len(runs) for key in runs[0]}
+    summary['worst_pnl'] = min(r['pnl'] for r in runs)
+    return dict(params, **summary)
+
+
+def parse_list(value, cast=float):
+    return [cast(v) for v in str(value).split(',') if v.strip()]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay the trailing-stop / re-entry strategy over price series")
+    parser.add_argument('--csv', action='append', help="OHLCV csv file (repeatable)")
+    parser.add_argument('--fetch', help="fetch OHLCV for this symbol from Phemex, e.g. BTC/USDT:USDT")
+    parser.add_argument('--timeframe', default='1h')
+    parser.add_argument('--bars', type=int, default=1000, help="bars per synthetic series / to fetch")
+    parser.add_argument('--seeds', type=int, default=4, help="synthetic series per combination")
+    parser.add_argument('--volatility', type=float, default=0.01)
+    parser.add_argument('--drift', type=float, default=0.0)
+    parser.add_argument('--side', default='long', choices=['long', 'short'])
+    parser.add_argument('--balance', type=float, default=1000.0)
+    parser.add_argument('--stake', type=float, default=100.0, help="notional of each new position")
+    parser.add_argument('--leverage', default='10')
+    parser.add_argument('--breath-threshold', default='0.05,0.10,0.20')
+    parser.add_argument('--threshold', default='0.10')
+    parser.add_argument('--target', default='0.06')
+    parser.add_argument('--reentry-mult', default='1.0,1.5,2.0')
+    parser.add_argument('--reentry-fraction', default='0.2')
+    parser.add_argument('--trail-mode', default='step', choices=['step', 'percent', 'fixed'],
+                        help="continuous modes trail --trail-distance behind the high-water mark")
+    parser.add_argument('--trail-distance', default='0.01')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--out', help="write every result to this JSON file")
+    args = parser.parse_args()
+
+    if args.csv:
+        series = [load_csv_bars(path) for path in args.csv]
+    elif args.fetch:
+        series = [fetch_bars(args.fetch, args.timeframe, args.bars)]
+    else:
+        series = [synthetic_bars(args.bars, args.volatility, args.drift, seed=seed) for seed in range(args.seeds)]
+
+    grid = [
+        {
+            'side': args.side, 'balance': args.balance, 'stake': args.stake, 'leverage': leverage,
+            'breath_threshold': breath_threshold,
+            'threshold': threshold, 'target': target,
+            'reentry_mult': reentry_mult, 'reentry_fraction': reentry_fraction,
+            'trail_mode': args.trail_mode, 'trail_distance': trail_distance,
+        }
+        for leverage, breath_threshold, threshold, target, reentry_mult, reentry_fraction, trail_distance in itertools.product(
+            parse_list(args.leverage), parse_list(args.breath_threshold),
+            parse_list(args.threshold), parse_list(args.target), parse_list(args.reentry_mult),
+            parse_list(args.reentry_fraction), parse_list(args.trail_distance),
+        )
+    ]
+    print(f"🧪 {len(grid)} parameter sets x {len(series)} series on {args.workers} workers")
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(series,)) as pool:
+        results = list(pool.map(run_combo, grid, chunksize=max(1, len(grid) // (args.workers * 4))))
+    print(f"⏱️ Done in {time.perf_counter() - started:.1f}s")
+
+    results.sort(key=lambda r: r['pnl'], reverse=True)
+    header = f"{'lev':>4} {'b_thr':>6} {'thr':>5} {'tgt':>5} {'mult':>5} {'frac':>5} {'dist':>6} | {'pnl':>9} {'worst':>9} {'maxDD':>6} {'stops':>6} {'re-ent':>6} {'liqs':>5}"
+    print(header)
+    print('-' * len(header))
+    for r in results[:args.top]:
+        print(
+            f"{r['leverage']:>4g} {r['breath_threshold']:>6g} {r['threshold']:>5g} {r['target']:>5g} "
+            f"{r['reentry_mult']:>5g} {r['reentry_fraction']:>5g} {r['trail_distance'] if r['trail_mode'] != 'step' else '-':>6} | {r['pnl']:>9.2f} {r['worst_pnl']:>9.2f} "
+            f"{r['max_drawdown'] * 100:>5.1f}% {r['stop_hits']:>6.1f} {r['reentries']:>6.1f} {r['liquidations']:>5.1f}"
+        )
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"💾 Wrote {len(results)} results to {args.out}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,411 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+import tracemalloc
+
+from collections import Counter, deque
+
+# The bot must never touch the live trailing state from a benchmark
+os.environ['TRAILING_DB'] = ':memory:'
+os.environ['JOURNAL_DB'] = ':memory:'
+
+import ccxt
+
+import accounts
+import main
+from accounts import Account
+from account import take_snapshot
+from trailing_store import TrailingStore
+
+# Thousands of decisions per run; the bot's own log lines would swamp the timings
+logging.disable(logging.CRITICAL)
+
+
+class FakePhemex:
+    # In-process stand-in for ccxt.phemex. Every request sleeps for a seeded,
+    # jittered latency and goes through self.throttle like ccxt's fetch2, so
+    # the bot's request scheduler spaces it out. Optionally the "server" also
+    # rejects anything over server_limit requests per second with
+    # RateLimitExceeded. Like Phemex, fetch_open_orders needs a symbol.
+    id = 'phemex'
+
+    def __init__(self, rate_limit_ms=0, latency=0.02, jitter=0.005, server_limit=0, seed=0):
+        self.rateLimit = rate_limit_ms
+        self.latency = latency
+        self.jitter = jitter
+        self.server_limit = server_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.recent = deque()
+        self.next_id = 1
+        self.has = {'editOrder': True, 'cancelOrders': None, 'createOrders': None}
+        self.markets = {}
+        self.positions = {}
+        self.orders = {}
+        self.balance = {'USDT': {'free': 1_000_000.0, 'used': 0.0, 'total': 1_000_000.0}}
+
+    def throttle(self, cost=None):
+        pass
+
+    def _request(self, endpoint):
+        self.throttle(1)
+        with self.lock:
+            self.calls[endpoint] += 1
+            now = time.monotonic()
+            if self.server_limit:
+                while self.recent and now - self.recent[0] >= 1.0:
+                    self.recent.popleft()
+                if len(self.recent) >= self.server_limit:
+                    self.errors[endpoint] += 1
+                    raise ccxt.RateLimitExceeded(f"phemex {endpoint} 429 Too Many Requests")
+                self.recent.append(now)
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    # World setup, free of charge
+
+    def add_market(self, symbol):
+        base = symbol.split('/')[0]
+        self.markets[symbol] = {
+            'symbol': symbol, 'id': f"{base}USDT", 'type': 'swap', 'swap': True, 'linear': True,
+            'settle': 'USDT', 'active': True, 'contractSize': 1,
+            'precision': {'price': 0.001, 'amount': 0.1}, 'limits': {},
+        }
+
+    def add_position(self, symbol, side, entry, mark, liquidation, contracts=10.0, leverage=10):
+        self.positions[symbol] = {
+            'symbol': symbol, 'side': side, 'contracts': contracts,
+            'entryPrice': entry, 'markPrice': mark, 'liquidationPrice': liquidation,
+            'leverage': leverage, 'notional': contracts * mark,
+            'info': {'posSide': 'Merged', 'curTermRealisedPnlRv': '0'},
+        }
+
+    def add_order(self, symbol, type, side, amount, price=None, stop_price=None):
+        with self.lock:
+            order_id = str(self.next_id)
+            self.next_id += 1
+        order = {
+            'id': order_id, 'symbol': symbol, 'type': type, 'side': side, 'amount': amount,
+            'price': price, 'stopPrice': stop_price, 'status': 'open', 'info': {'posSide': 'Merged'},
+        }
+        self.orders[order_id] = order
+        return order
+
+    # ccxt surface the bot uses
+
+    def load_markets(self, reload=False, params={}):
+        self._request('load_markets')
+        return self.markets
+
+    def fetch_positions(self, symbols=None, params={}):
+        self._request('fetch_positions')
+        wanted = set(symbols) if symbols else None
+        return [dict(p) for s, p in self.positions.items() if wanted is None or s in wanted]
+
+    def fetch_balance(self, params={}):
+        self._request('fetch_balance')
+        return {k: dict(v) for k, v in self.balance.items()}
+
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        self._request('fetch_open_orders')
+        if symbol is None:
+            raise ccxt.ArgumentsRequired("phemex fetchOpenOrders() requires a symbol argument")
+        return [dict(o) for o in list(self.orders.values()) if o['symbol'] == symbol]
+
+    fetchOpenOrders = fetch_open_orders
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self._request('create_order')
+        return dict(self.add_order(symbol, type, side, amount, price, params.get('stopPx')))
+
+    def cancel_order(self, id, symbol=None, params={}):
+        self._request('cancel_order')
+        order = self.orders.pop(id, None)
+        if order is None:
+            raise ccxt.OrderNotFound(f"phemex order {id} not found")
+        return dict(order, status='canceled')
+
+    def edit_order(self, id, symbol, type, side, amount=None, price=None, params={}):
+        self._request('edit_order')
+        order = self.orders.get(id)
+        if order is None:
+            raise ccxt.OrderNotFound(f"phemex order {id} not found")
+        order.update(amount=amount or order['amount'], stopPrice=params.get('stopPx', order['stopPrice']))
+        return dict(order)
+
+
+def build_world(positions, args):
+    # A fresh exchange and fresh bot state. Positions cycle through:
+    #   0 - in profit past the threshold, its stop gets moved
+    #   1 - gave its profit back with a live stop, state and stop get dropped
+    #   2 - near liquidation, no re-entry order yet
+    #   3 - quiet, already has its same-side re-entry limit
+    # On top, every tenth flat market has a stale trailing state and an
+    # orphaned limit order for cleanup to find.
+    rng = random.Random(args.seed)
+    exchange = main.schedule_requests(
+        FakePhemex(args.rate_limit_ms, args.latency, args.jitter, args.server_limit, args.seed)
+    )
+
+    account = Account('bench', exchange, TrailingStore(':memory:'))
+    accounts.set_default(account)
+    main.market_caches.clear()
+    main.candle_caches.clear()
+
+    flat = positions // 2 + 10
+    for i in range(positions + flat):
+        exchange.add_market(f"B{i:04d}/USDT:USDT")
+
+    for i in range(positions):
+        symbol = f"B{i:04d}/USDT:USDT"
+        side = 'long' if i % 2 == 0 else 'short'
+        sign = 1 if side == 'long' else -1
+        entry = round(rng.uniform(1, 500), 3)
+        liquidation = entry * (1 - sign * 0.09)
+        kind = i % 4
+        if kind == 0:
+            mark = entry * (1 + sign * rng.uniform(0.012, 0.03))
+        elif kind == 1:
+            mark = entry * (1 - sign * rng.uniform(0.001, 0.01))
+            stop = exchange.add_order(symbol, 'stop', 'sell' if side == 'long' else 'buy', 10.0,
+                                      stop_price=entry * (1 + sign * 0.006))
+            account.trailing_store.set(symbol, side, dict(main.DEFAULT_TRAILING, orderId=stop['id'],
+                                                           side='buy' if side == 'long' else 'sell'))
+        elif kind == 2:
+            mark = liquidation + (entry - liquidation) * rng.uniform(0.1, 0.3)
+        else:
+            mark = entry * (1 + sign * rng.uniform(-0.004, 0.004))
+            exchange.add_order(symbol, 'limit', 'buy' if side == 'long' else 'sell', 15.0,
+                               price=entry + (liquidation - entry) * 0.2)
+        exchange.add_position(symbol, side, entry, round(mark, 3), round(liquidation, 3))
+
+    for i in range(positions, positions + flat, 10):
+        symbol = f"B{i:04d}/USDT:USDT"
+        account.trailing_store.set(symbol, 'long', dict(main.DEFAULT_TRAILING, side='buy'))
+        exchange.add_order(symbol, 'limit', 'buy', 5.0, price=1.0)
+
+    account.trailing_store.flush()
+    # Markets are loaded once per process in the bot, not once per stage
+    main.get_market_cache(exchange).symbols()
+    exchange.calls.clear()
+    return exchange
+
+
+def stage_main_job(exchange):
+    main.main_job()
+
+
+def stage_trailing(exchange):
+    gateway = main.new_order_gateway(exchange)
+    for pos in exchange.fetch_positions():
+        main.trailing_stop_logic(exchange, pos, 0.10, 0.10, gateway)
+    gateway.flush()
+    accounts.current().trailing_store.flush()
+
+
+def stage_reentry(exchange):
+    snapshot = take_snapshot(exchange, main.get_market_cache(exchange).symbols())
+    gateway = main.new_order_gateway(exchange)
+    exposure = main.new_exposure_model(exchange, snapshot)
+    for pos in snapshot.open_positions():
+        main.monitor_position_and_reenter(exchange, pos['symbol'], pos, snapshot, gateway, exposure)
+    gateway.flush()
+
+
+def stage_cleanup(exchange):
+    main.cleanup_job()
+
+
+def stage_orphan_scan(exchange):
+    # The commented-out "every symbol" call in main_job
+    main.cancel_orphan_orders(exchange, main.get_market_cache(exchange).symbols(), 'limit')
+
+
+def prepare_orphan_rescan(exchange):
+    # Same scan once the order index is warm and a tenth of the positions have closed
+    main.cancel_orphan_orders(exchange, main.get_market_cache(exchange).symbols(), 'limit')
+    for symbol in list(exchange.positions)[3::10]:
+        del exchange.positions[symbol]
+    exchange.calls.clear()
+
+
+STAGES = {
+    'main_job': stage_main_job,
+    'trailing': stage_trailing,
+    'reentry': stage_reentry,
+    'cleanup': stage_cleanup,
+    'orphan_scan': stage_orphan_scan,
+    'orphan_rescan': stage_orphan_scan,
+}
+
+# Run before the clock starts
+PREPARE = {
+    'orphan_rescan': prepare_orphan_rescan,
+}
+
+
+def run_stage(name, positions, args):
+    # Wall time and calls from plain runs, peak memory from one extra traced run
+    walls = []
+    calls = Counter()
+    errors = Counter()
+    failure = None
+    for _ in range(args.repeat):
+        exchange = build_world(positions, args)
+        if name in PREPARE:
+            PREPARE[name](exchange)
+        started = time.perf_counter()
+        try:
+            STAGES[name](exchange)
+        except Exception as e:
+            # A 429 escaping the bot is a result too, not a broken benchmark
+            failure = f"{type(e).__name__}: {e}"
+        walls.append(time.perf_counter() - started)
+        calls, errors = exchange.calls, exchange.errors
+
+    exchange = build_world(positions, args)
+    if name in PREPARE:
+        PREPARE[name](exchange)
+    tracemalloc.start()
+    try:
+        STAGES[name](exchange)
+    except Exception:
+        pass
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'positions': positions,
+        'wall': statistics.median(walls),
+        'wall_min': min(walls),
+        'calls': sum(calls.values()),
+        'calls_by_endpoint': dict(sorted(calls.items())),
+        'errors': sum(errors.values()),
+        'peak_kib': peak / 1024,
+        'failure': failure,
+    }
+
+
+def run_ticks(positions, args):
+    # Several main_job ticks on one world: the first does the work, later ones
+    # show the steady state once stops are moved and re-entries are resting
+    exchange = build_world(positions, args)
+    ticks = []
+    for _ in range(args.ticks):
+        exchange.calls.clear()
+        started = time.perf_counter()
+        main.main_job()  # catches and logs its own errors
+        ticks.append({'wall': time.perf_counter() - started, 'calls': sum(exchange.calls.values())})
+    return ticks
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in str(value).split(',') if v.strip()]
+
+
+def print_report(results, baseline=None):
+    base = {(r['stage'], r['positions']): r for r in (baseline or {}).get('results', [])}
+    header = f"{'stage':<13} {'pos':>5} | {'wall ms':>9} {'min ms':>9} {'calls':>6} {'429s':>5} {'peak KiB':>9}"
+    if base:
+        header += f" | {'wall Δ':>8} {'calls Δ':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        line = (
+            f"{r['stage']:<13} {r['positions']:>5} | {r['wall'] * 1000:>9.1f} {r['wall_min'] * 1000:>9.1f} "
+            f"{r['calls']:>6} {r['errors']:>5} {r['peak_kib']:>9.0f}"
+        )
+        old = base.get((r['stage'], r['positions']))
+        if old:
+            wall_delta = (r['wall'] - old['wall']) / old['wall'] * 100 if old['wall'] else 0.0
+            line += f" | {wall_delta:>+7.1f}% {r['calls'] - old['calls']:>+8}"
+        if r['failure']:
+            line += f"  ❌ {r['failure']}"
+        print(line)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Time the bot's hot paths against an in-process fake Phemex")
+    parser.add_argument('--positions', default='10,100,500', help="open positions per scenario")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"any of {', '.join(STAGES)}")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage; the median is reported")
+    parser.add_argument('--ticks', type=int, default=3, help="consecutive main_job ticks per scenario")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per simulated request")
+    parser.add_argument('--jitter', type=float, default=0.005, help="extra random latency, up to this many seconds")
+    parser.add_argument('--rate-limit-ms', type=float, default=0, help="client-side spacing between requests")
+    parser.add_argument('--server-limit', type=int, default=0, help="requests per second before the fake answers 429")
+    parser.add_argument('--workers', type=int, default=main.POSITION_WORKERS, help="POSITION_WORKERS for the bot")
+    parser.add_argument('--risk-mode', default=main.RISK_MODE, choices=['loop', 'vector'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run to show deltas against")
+    args = parser.parse_args()
+
+    main.POSITION_WORKERS = args.workers
+    main.RISK_MODE = args.risk_mode
+    stages = parse_list(args.stages, str)
+    revision = git_revision()
+    print(f"🧪 {revision or 'unknown revision'}: {len(stages)} stages x {args.positions} positions, "
+          f"{args.latency * 1000:g}ms latency, {args.workers} workers, {args.risk_mode} risk")
+
+    results = []
+    ticks = {}
+    for positions in parse_list(args.positions):
+        for stage in stages:
+            results.append(run_stage(stage, positions, args))
+        if args.ticks:
+            ticks[positions] = run_ticks(positions, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"📏 Compared against {baseline['meta'].get('revision') or args.compare}")
+        # Only the code should differ between the two runs, not the simulated world
+        old_args = baseline['meta'].get('args', {})
+        differing = [k for k in ('latency', 'jitter', 'rate_limit_ms', 'server_limit', 'workers', 'risk_mode', 'seed')
+                     if old_args.get(k) != getattr(args, k)]
+        if differing:
+            print(f"⚠️ Baseline was run with different {', '.join(differing)}; deltas are not like for like")
+    print_report(results, baseline)
+    for positions, runs in ticks.items():
+        print(f"⏱️ main_job x{len(runs)} @ {positions} positions: " + ', '.join(
+            f"{t['wall'] * 1000:.0f}ms/{t['calls']} calls" for t in runs
+        ))
+
+    if args.out:
+        meta = {
+            'revision': revision,
+            'python': platform.python_version(),
+            'ccxt': ccxt.__version__,
+            'args': vars(args),
+        }
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta, 'results': results, 'ticks': ticks}, f, indent=4)
+        print(f"💾 Wrote {len(results)} results to {args.out}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,178 @@
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+# Rolling figures over the last `window` candles of a symbol:
+#   atr        - mean true range, in price units
+#   volatility - standard deviation of the candle-to-candle log returns
+#   vwap       - volume-weighted typical price (None while there's no volume)
+Indicators = namedtuple('Indicators', ['atr', 'volatility', 'vwap', 'close', 'bars'])
+
+TIMEFRAME_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+TS, OPEN, HIGH, LOW, CLOSE, VOLUME = range(6)
+# What every candle adds to the rolling sums
+TR, RET, RET2, PV, VOL = range(5)
+
+
+def timeframe_seconds(timeframe):
+    return int(timeframe[:-1]) * TIMEFRAME_SECONDS[timeframe[-1]]
+
+
+class CandleSeries:
+    # The last `capacity` candles of one symbol in a NumPy ring buffer, with
+    # running sums over the last `window` of them. A new candle adds its
+    # share to the sums and takes out the share of the one leaving the
+    # window; rewriting the newest candle swaps its share. Both are O(1).
+    def __init__(self, capacity=500, window=14):
+        if window >= capacity:
+            raise ValueError(f"window ({window}) must be smaller than capacity ({capacity})")
+        self.capacity = capacity
+        self.window = window
+        self.bars = np.zeros((capacity, 6))
+        self.shares = np.zeros((capacity, 5))
+        self.sums = np.zeros(5)
+        self.count = 0
+
+    def last(self):
+        return self.bars[(self.count - 1) % self.capacity] if self.count else None
+
+    def _share(self, k, bar):
+        share = np.zeros(5)
+        if k > 0:
+            previous_close = self.bars[(k - 1) % self.capacity][CLOSE]
+            share[TR] = max(bar[HIGH], previous_close) - min(bar[LOW], previous_close)
+            if previous_close > 0 and bar[CLOSE] > 0:
+                share[RET] = math.log(bar[CLOSE] / previous_close)
+                share[RET2] = share[RET] ** 2
+        else:
+            share[TR] = bar[HIGH] - bar[LOW]
+        share[PV] = (bar[HIGH] + bar[LOW] + bar[CLOSE]) / 3 * bar[VOLUME]
+        share[VOL] = bar[VOLUME]
+        return share
+
+    def append(self, bar):
+        k = self.count
+        share = self._share(k, bar)
+        self.bars[k % self.capacity] = bar
+        self.sums += share
+        if k >= self.window:
+            self.sums -= self.shares[(k - self.window) % self.capacity]
+        self.shares[k % self.capacity] = share
+        self.count += 1
+        if self.count % self.capacity == 0:
+            # Re-add from scratch now and then so rounding errors can't pile up
+            self.sums = self.shares[[i % self.capacity for i in range(self.count - self._size(), self.count)]].sum(axis=0)
+
+    def replace_last(self, bar):
+        k = self.count - 1
+        self.sums -= self.shares[k % self.capacity]
+        share = self._share(k, bar)
+        self.bars[k % self.capacity] = bar
+        self.shares[k % self.capacity] = share
+        self.sums += share
+
+    def merge(self, candles):
+        # ccxt OHLCV rows; rows we already have are rewritten, older ones ignored
+        for candle in candles:
+            bar = [float(v or 0) for v in candle[:6]]
+            last = self.last()
+            if last is not None and bar[TS] == last[TS]:
+                self.replace_last(bar)
+            elif last is None or bar[TS] > last[TS]:
+                self.append(bar)
+
+    def update_price(self, price, ts, timeframe_ms):
+        # Folds a mark into the candle it belongs to, opening a new one (with no volume) if needed
+        start = ts - ts % timeframe_ms
+        last = self.last()
+        if last is None or start < last[TS]:
+            return
+        if start == last[TS]:
+            self.replace_last([last[TS], last[OPEN], max(last[HIGH], price), min(last[LOW], price), price, last[VOLUME]])
+        else:
+            self.append([start, price, price, price, price, 0.0])
+
+    def _size(self):
+        return min(self.count, self.window)
+
+    def indicators(self):
+        n = self._size()
+        if n == 0:
+            return None
+        mean = self.sums[RET] / n
+        return Indicators(
+            atr=float(self.sums[TR] / n),
+            volatility=math.sqrt(max(self.sums[RET2] / n - mean * mean, 0.0)),
+            vwap=float(self.sums[PV] / self.sums[VOL]) if self.sums[VOL] > 0 else None,
+            close=float(self.last()[CLOSE]),
+            bars=self.count,
+        )
+
+
+class CandleCache:
+    # Candles per symbol, seeded with one fetch_ohlcv and then kept current
+    # from the marks we see anyway, plus one small fetch_ohlcv (since our
+    # newest candle) per symbol per timeframe to pick up real highs, lows and
+    # volume. Only symbols someone asked indicators for are tracked. A seed
+    # fetch that fails is tried again after retry_after seconds.
+    def __init__(self, timeframe='15m', capacity=500, window=14, retry_after=10):
+        self.timeframe = timeframe
+        self.timeframe_ms = timeframe_seconds(timeframe) * 1000
+        self.capacity = capacity
+        self.window = window
+        self.lock = threading.Lock()
+        self.series = {}
+        self.synced_at = {}
+        self.retry_after_ms = retry_after * 1000
+        self.retry_at = {}
+
+    def _sync(self, exchange, symbol):
+        series = self.series.get(symbol)
+        now = time.time() * 1000
+        if series is None:
+            if now < self.retry_at.get(symbol, 0):
+                return None
+        elif now - self.synced_at.get(symbol, 0) < self.timeframe_ms:
+            return series
+        last = series.last() if series is not None else None
+        try:
+            if last is None:
+                candles = exchange.fetch_ohlcv(symbol, self.timeframe, limit=self.capacity)
+            else:
+                candles = exchange.fetch_ohlcv(symbol, self.timeframe, since=int(last[TS]))
+        except Exception as e:
+            log.warning("⚠️ Failed to fetch %s candles for %s: %s", self.timeframe, symbol, e)
+            if series is None:
+                # Nothing to go on until it works, so try again soon
+                self.retry_at[symbol] = now + self.retry_after_ms
+            else:
+                # The candles we have do until the next one
+                self.synced_at[symbol] = now
+            return series
+        with self.lock:
+            if series is None:
+                series = self.series[symbol] = CandleSeries(self.capacity, self.window)
+            series.merge(candles)
+            self.synced_at[symbol] = now
+        return series
+
+    def indicators(self, exchange, symbol):
+        series = self._sync(exchange, symbol)
+        if series is None:
+            return None
+        with self.lock:
+            return series.indicators()
+
+    def on_mark(self, symbol, price, ts=None):
+        with self.lock:
+            series = self.series.get(symbol)
+            if series is not None and price:
+                series.update_price(float(price), ts if ts is not None else time.time() * 1000, self.timeframe_ms)
@@ -0,0 +1,99 @@
+import threading
+
+
+class ExposureModel:
+    # Free margin and notional exposure of one account for one tick, built
+    # from the tick's snapshot. Re-entries reserve their margin and notional
+    # here as they're planned, so the ones decided later in the tick see
+    # what the earlier ones took, without asking the exchange again.
+    #
+    # Notional counts open positions plus resting re-entry limits (they add
+    # to the position once they fill). Their margin is already held by the
+    # exchange, so it's not in `free` to begin with.
+    #
+    # free can be a callable returning it; it's then called once, on the
+    # first reservation, so ticks that plan no re-entry never pay for it.
+    def __init__(self, free, positions=(), orders=None, currency='USDT', margin_buffer=0.0,
+                 max_symbol_notional=0.0, max_total_notional=0.0, min_fit=0.0):
+        self.lock = threading.Lock()
+        self.currency = currency
+        self.margin_buffer = margin_buffer
+        self.free = None
+        self.load_free = free if callable(free) else None
+        if self.load_free is None:
+            self._set_free(free)
+        self.max_symbol_notional = max_symbol_notional
+        self.max_total_notional = max_total_notional
+        self.min_fit = min_fit
+        self.reserved = 0.0
+        self.leverage = {}
+        self.notional = {}
+        self.pending = {}
+        for p in positions:
+            if float(p.get('contracts') or 0) <= 0:
+                continue
+            key = (p['symbol'], (p.get('side') or '').lower())
+            self.leverage[key] = float(p.get('leverage') or 1) or 1.0
+            self.notional[p['symbol']] = self.notional.get(p['symbol'], 0.0) + abs(float(p.get('notional') or 0))
+        for symbol, symbol_orders in (orders or {}).items():
+            for o in symbol_orders or ():
+                if o.get('type') == 'limit' and not o.get('reduceOnly') and o.get('price'):
+                    remaining = o.get('remaining') if o.get('remaining') is not None else o.get('amount')
+                    self.pending[symbol] = self.pending.get(symbol, 0.0) + float(remaining or 0) * float(o['price'])
+
+    def _set_free(self, free):
+        self.free = max(float(free or 0) * (1 - self.margin_buffer), 0.0)
+
+    def _free(self):
+        if self.free is None:
+            self._set_free(self.load_free())
+        return self.free
+
+    @classmethod
+    def from_snapshot(cls, snapshot, fetch_balance=None, **limits):
+        # fetch_balance() stands in for the balance of a snapshot taken without one
+        currency = limits.get('currency', 'USDT')
+        if snapshot.balance is not None or fetch_balance is None:
+            free = snapshot.free(currency)
+        else:
+            free = lambda: (fetch_balance().get(currency) or {}).get('free', 0)
+        return cls(free, snapshot.positions, snapshot.orders, **limits)
+
+    def symbol_notional(self, symbol):
+        with self.lock:
+            return self.notional.get(symbol, 0.0) + self.pending.get(symbol, 0.0)
+
+    def total_notional(self):
+        with self.lock:
+            return sum(self.notional.values()) + sum(self.pending.values())
+
+    def available(self):
+        with self.lock:
+            return self._free() - self.reserved
+
+    def reserve(self, symbol, side, price, amount, contract_size=1.0):
+        # How much of `amount` fits: all of it, a scaled-down part, or 0 when
+        # less than min_fit of it would. Whatever is returned is reserved.
+        notional = price * amount * contract_size
+        if notional <= 0:
+            return 0.0
+        with self.lock:
+            leverage = self.leverage.get((symbol, side), 1.0)
+            room = (self._free() - self.reserved) * leverage
+            if self.max_symbol_notional:
+                room = min(room, self.max_symbol_notional - self.notional.get(symbol, 0.0) - self.pending.get(symbol, 0.0))
+            if self.max_total_notional:
+                room = min(room, self.max_total_notional - sum(self.notional.values()) - sum(self.pending.values()))
+            fit = min(1.0, max(room, 0.0) / notional)
+            if fit <= 0 or fit < self.min_fit:
+                return 0.0
+            self.reserved += notional * fit / leverage
+            self.pending[symbol] = self.pending.get(symbol, 0.0) + notional * fit
+            return amount * fit
+
+    def release(self, symbol, side, price, amount, contract_size=1.0):
+        # Hands back a reservation whose order never made it to the book
+        notional = price * amount * contract_size
+        with self.lock:
+            self.reserved -= notional / self.leverage.get((symbol, side), 1.0)
+            self.pending[symbol] = self.pending.get(symbol, 0.0) - notional
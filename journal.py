@@ -0,0 +1,322 @@
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Kinds of event in the journal:
+#   order - a create / cancel / amend of ours went through (action says which)
+#   fill  - part of a position was opened or closed; pnl is what closing realized
+#   stop  - the trailing stop moved, was dropped, or (local mode) fired
+#   seed  - first sight of a position opened before the journal knew about it
+EVENT_COLUMNS = ('id', 'ts', 'kind', 'symbol', 'side', 'action', 'order_id', 'price', 'amount', 'fee', 'pnl', 'data')
+
+
+def position_side(order_side, reduce_only=False, pos_side=None):
+    # The position an order works on: hedge-mode orders say so, one-way ones
+    # open the side they buy / sell into unless they only reduce
+    pos_side = (pos_side or '').lower()
+    if pos_side in ('long', 'short'):
+        return pos_side
+    if not order_side:
+        return None
+    buying = (order_side or '').lower() == 'buy'
+    return ('short' if buying else 'long') if reduce_only else ('long' if buying else 'short')
+
+
+class Journal:
+    # Append-only record of our orders, fills and stop moves, plus a ledger
+    # per (symbol, side) with contracts, average entry, realized PnL and fees
+    # that every fill updates in place. Like the trailing store, events and
+    # ledger changes are kept in memory and written together by flush(), one
+    # SQLite transaction per tick.
+    #
+    # Fills come from what we see anyway: orders that come back filled, order
+    # updates from the feed and, for fills that happen on the exchange while
+    # we only poll (stops going off, re-entries filling), the difference
+    # between a position and its ledger entry. Trade history is never fetched.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.pending = []
+        self.ledger = {}
+        self.dirty = set()
+        self.filled = {}
+        # Last mark seen per symbol, to price closes of positions that drop out of view
+        self.marks = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY, ts REAL NOT NULL, kind TEXT NOT NULL, symbol TEXT NOT NULL,"
+            " side TEXT, action TEXT, order_id TEXT, price REAL, amount REAL, fee REAL, pnl REAL, data TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_symbol_ts ON events (symbol, ts)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_kind_ts ON events (kind, ts)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_order ON events (order_id) WHERE order_id IS NOT NULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS positions ("
+            " symbol TEXT NOT NULL, side TEXT NOT NULL, contracts REAL NOT NULL, entry REAL NOT NULL,"
+            " realized REAL NOT NULL, fees REAL NOT NULL, updated REAL NOT NULL,"
+            " PRIMARY KEY (symbol, side))"
+        )
+        for symbol, side, contracts, entry, realized, fees, updated in self.conn.execute("SELECT * FROM positions"):
+            self.ledger[(symbol, side)] = {
+                'contracts': contracts, 'entry': entry, 'realized': realized, 'fees': fees, 'updated': updated,
+            }
+        # How much of each order we've already booked, so a feed replaying an
+        # order's cumulative fill after a restart isn't counted twice
+        for order_id, amount in self.conn.execute(
+            "SELECT order_id, SUM(amount) FROM events WHERE kind = 'fill' AND order_id IS NOT NULL GROUP BY order_id"
+        ):
+            self.filled[order_id] = amount
+
+    def _append(self, kind, symbol, side=None, action=None, order_id=None, price=None, amount=None,
+                fee=None, pnl=None, ts=None, **data):
+        data = {key: value for key, value in data.items() if value is not None}
+        self.pending.append((
+            ts if ts is not None else time.time(), kind, symbol, side, action, order_id,
+            price, amount, fee, pnl, json.dumps(data, default=str) if data else None,
+        ))
+
+    def _fill(self, symbol, side, order_side, price, amount, fee=0.0, contract_size=1.0, order_id=None, ts=None, **data):
+        # One fill against the ledger: opening fills move the average entry,
+        # closing fills realize (price - entry) on what they close
+        key = (symbol, side)
+        position = self.ledger.setdefault(key, {'contracts': 0.0, 'entry': 0.0, 'realized': 0.0, 'fees': 0.0})
+        opening = (order_side == 'buy') == (side == 'long')
+        pnl = 0.0
+        if opening:
+            contracts = position['contracts'] + amount
+            position['entry'] = (position['entry'] * position['contracts'] + price * amount) / contracts if contracts else 0.0
+            position['contracts'] = contracts
+        else:
+            closed = min(amount, position['contracts'])
+            sign = 1 if side == 'long' else -1
+            pnl = sign * (price - position['entry']) * closed * contract_size
+            position['contracts'] -= closed
+            if position['contracts'] <= 1e-12:
+                position['contracts'] = 0.0
+                position['entry'] = 0.0
+        pnl -= fee or 0.0
+        position['realized'] += pnl
+        position['fees'] += fee or 0.0
+        position['updated'] = ts if ts is not None else time.time()
+        self.dirty.add(key)
+        self._append('fill', symbol, side, 'open' if opening else 'close', order_id, price, amount, fee, pnl, ts, **data)
+
+    def record_order(self, action, op, result, contract_size=1.0):
+        # What the order gateway did; orders that come back (partly) filled are booked as fills too
+        result = result or {}
+        params = op.get('params') or {}
+        order_side = result.get('side') or op.get('side')
+        side = position_side(order_side, params.get('reduceOnly') or params.get('closeOnTrigger'), op.get('pos_side'))
+        order_id = result.get('id') or op.get('id')
+        with self.lock:
+            self._append(
+                'order', op['symbol'], side, action, order_id,
+                op.get('stop_price') or op.get('price') or result.get('price'),
+                op.get('amount') or result.get('amount'),
+                type=result.get('type') or op.get('type'),
+                replaced=op.get('id') if action == 'move' and op.get('id') != order_id else None,
+            )
+            if action != 'cancel':
+                self._book_fill(result, op['symbol'], side, order_side, contract_size)
+
+    def record_order_update(self, order, contract_size=1.0):
+        # An order event from the feed; only its new fills matter here
+        info = order.get('info') or {}
+        side = position_side(order.get('side'), order.get('reduceOnly'), info.get('posSide'))
+        with self.lock:
+            self._book_fill(order, order['symbol'], side, order.get('side'), contract_size)
+
+    def _book_fill(self, order, symbol, side, order_side, contract_size):
+        order_id = order.get('id')
+        filled = float(order.get('filled') or 0)
+        price = order.get('average') or order.get('price')
+        if not order_id or filled <= 0 or not price:
+            return
+        new = filled - self.filled.get(order_id, 0.0)
+        if new <= 1e-12:
+            return
+        self.filled[order_id] = filled
+        fee = float((order.get('fee') or {}).get('cost') or 0)
+        # Cumulative fee on the order; book the share of this fill
+        self._fill(symbol, side, order_side, float(price), new, fee * new / filled, contract_size, order_id,
+                   source='order')
+
+    def record_stop(self, symbol, side, action, price=None, order_id=None, **data):
+        with self.lock:
+            self._append('stop', symbol, side, action, order_id, price, **data)
+
+    def observe_positions(self, positions, contract_sizes=None, as_of=None, complete=False):
+        # Squares the ledger with the exchange's positions. A position we've
+        # never seen is seeded as it is; any other difference is a fill we
+        # didn't hear about, priced from the new entry price when the
+        # position grew and at the mark when it shrank. Open ledger entries
+        # the positions don't show open were closed at the mark: on symbols
+        # they mention (ccxt reports a flat one-way Phemex position as a
+        # short), or anywhere when complete says they list every position.
+        # as_of is when the positions were read: ledger entries a fill has
+        # updated since are newer than what we're shown, and are left alone.
+        contract_sizes = contract_sizes or {}
+        with self.lock:
+            held = {}
+            symbols = set()
+            for p in positions:
+                symbols.add(p['symbol'])
+                if p.get('markPrice'):
+                    self.marks[p['symbol']] = float(p['markPrice'])
+                side = (p.get('side') or '').lower()
+                if side in ('long', 'short') and float(p.get('contracts') or 0) > 0:
+                    held[(p['symbol'], side)] = p
+
+            for (symbol, side), p in held.items():
+                contracts = float(p['contracts'])
+                entry = float(p.get('entryPrice') or 0)
+                mark = float(p.get('markPrice') or 0)
+                position = self.ledger.get((symbol, side))
+                if self._newer(position, as_of):
+                    continue
+                if position is None or (position['contracts'] == 0 and not position['entry']):
+                    self.ledger[(symbol, side)] = {
+                        'contracts': contracts, 'entry': entry,
+                        'realized': position['realized'] if position else 0.0,
+                        'fees': position['fees'] if position else 0.0,
+                        'updated': as_of if as_of is not None else time.time(),
+                    }
+                    self.dirty.add((symbol, side))
+                    self._append('seed', symbol, side, None, None, entry, contracts)
+                    continue
+                delta = contracts - position['contracts']
+                if abs(delta) <= 1e-12:
+                    continue
+                if delta > 0:
+                    price = (entry * contracts - position['entry'] * position['contracts']) / delta if entry else mark
+                    order_side = 'buy' if side == 'long' else 'sell'
+                else:
+                    price = mark or position['entry']
+                    order_side = 'sell' if side == 'long' else 'buy'
+                if price <= 0:
+                    continue
+                self._fill(symbol, side, order_side, price, abs(delta), 0.0, contract_sizes.get(symbol, 1.0),
+                           source='position')
+
+            for (symbol, side), position in list(self.ledger.items()):
+                if position['contracts'] <= 0 or (symbol, side) in held or self._newer(position, as_of):
+                    continue
+                if symbol not in symbols and not complete:
+                    continue
+                # With no mark since a restart the close is booked flat, at entry
+                price = self.marks.get(symbol) or position['entry']
+                self._fill(symbol, side, 'sell' if side == 'long' else 'buy', price, position['contracts'], 0.0,
+                           contract_sizes.get(symbol, 1.0), source='position')
+
+    @staticmethod
+    def _newer(position, as_of):
+        return position is not None and as_of is not None and position.get('updated', 0) > as_of
+
+    def position(self, symbol, side):
+        with self.lock:
+            position = self.ledger.get((symbol, side))
+            return dict(position) if position is not None else None
+
+    def positions(self):
+        with self.lock:
+            return {key: dict(value) for key, value in self.ledger.items()}
+
+    def flush(self):
+        with self.lock:
+            if not self.pending and not self.dirty:
+                return 0
+            events, self.pending = self.pending, []
+            writes = [(key, dict(self.ledger[key])) for key in self.dirty if key in self.ledger]
+            self.dirty.clear()
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT INTO events (ts, kind, symbol, side, action, order_id, price, amount, fee, pnl, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    events,
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO positions (symbol, side, contracts, entry, realized, fees, updated)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(symbol, side, p['contracts'], p['entry'], p['realized'], p['fees'], p.get('updated', time.time()))
+                     for (symbol, side), p in writes],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # Nothing was written, keep it all for the next flush
+                self.pending[:0] = events
+                self.dirty.update(key for key, _ in writes)
+                raise
+            return len(events)
+
+    # --- queries, on what has been flushed ---
+
+    def events(self, symbol=None, kind=None, since=None, until=None, limit=None):
+        clauses, args = [], []
+        for column, op, value in (('symbol', '=', symbol), ('kind', '=', kind), ('ts', '>=', since), ('ts', '<', until)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                args.append(value)
+        sql = "SELECT * FROM events" + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY id"
+        if limit:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return [dict(zip(EVENT_COLUMNS, row), data=json.loads(row[-1]) if row[-1] else {}) for row in rows]
+
+    def realized_pnl(self, symbol=None, since=None, until=None):
+        # Realized PnL net of fees over a time range, by (symbol, side)
+        clauses, args = ["kind = 'fill'"], []
+        for column, op, value in (('symbol', '=', symbol), ('ts', '>=', since), ('ts', '<', until)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                args.append(value)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT symbol, side, SUM(pnl), SUM(fee), COUNT(*) FROM events WHERE " + " AND ".join(clauses)
+                + " GROUP BY symbol, side ORDER BY SUM(pnl) DESC",
+                args,
+            ).fetchall()
+        return [{'symbol': s, 'side': side, 'pnl': pnl or 0.0, 'fees': fee or 0.0, 'fills': n} for s, side, pnl, fee, n in rows]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Summarize the trade journal")
+    parser.add_argument('path', nargs='?', default='journal.db')
+    parser.add_argument('--symbol')
+    parser.add_argument('--hours', type=float, help="only the last N hours")
+    parser.add_argument('--events', type=int, default=0, help="also print the last N events")
+    args = parser.parse_args()
+
+    journal = Journal(args.path)
+    since = time.time() - args.hours * 3600 if args.hours else None
+    rows = journal.realized_pnl(args.symbol, since)
+    print(f"{'symbol':<24} {'side':<6} {'fills':>6} {'fees':>10} {'pnl':>12}")
+    for r in rows:
+        print(f"{r['symbol']:<24} {r['side']:<6} {r['fills']:>6} {r['fees']:>10.4f} {r['pnl']:>12.4f}")
+    print(f"{'total':<24} {'':<6} {sum(r['fills'] for r in rows):>6} {sum(r['fees'] for r in rows):>10.4f} "
+          f"{sum(r['pnl'] for r in rows):>12.4f}")
+    if args.events:
+        for event in journal.events(args.symbol, since=since)[-args.events:]:
+            print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['ts'])), event['kind'], event['action'] or '',
+                  event['symbol'], event['side'] or '', event['price'], event['amount'], event['pnl'] or '', event['data'])
+    journal.conn.close()
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,70 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; decision records carry their fields at the top level
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        account = getattr(record, 'account', None)
+        if account:
+            entry['account'] = account
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    # The stock handler renders the message into a string before queueing it.
+    # Keep the record as is (minus the live traceback) so the background
+    # thread does all the formatting and JSON still sees the raw fields.
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level='INFO', fmt='text', stream=None, text_format='%(message)s', filters=()):
+    # Callers only pay for putting a record on a queue; a background thread
+    # formats and writes it, so slow stdout never holds up a tick.
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(text_format))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    queue_handler = QueueHandler(records)
+    # Filters run here, in the thread that logged, so they can see its context
+    for record_filter in filters:
+        queue_handler.addFilter(record_filter)
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener.start()
+    # Drain whatever is still queued before the process goes away
+    atexit.register(listener.stop)
+    return listener
+
+
+def decision(logger, action, symbol, side=None, message=None, level=logging.INFO, **fields):
+    # A single record per trading decision: what was done, to which position, at which prices
+    if not logger.isEnabledFor(level):
+        return
+    fields = {'action': action, 'symbol': symbol, 'side': side, **fields}
+    logger.log(level, message or f"{action} {symbol} {side or ''}".rstrip(), extra={'fields': fields})
@@ -3,10 +3,26 @@ import os
 import time
 import threading
 import queue
-import json
 import math
-import schedule
-import traceback
+import atexit
+import contextvars
+import functools
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from stream import StreamEngine, ReplayTransport, SocketTransport, CcxtProTransport
+from trailing_store import TrailingStore
+from journal import Journal
+from markets import MarketCache
+from account import AccountSnapshot, take_snapshot
+from order_gateway import OrderGateway
+from trailing import TRAIL_MODES, high_water_mark, ratchet
+from exposure import ExposureModel
+from scheduler import TickScheduler
+from metrics import Metrics, InstrumentedExchange
+from ratelimit import RequestScheduler, ScheduledExchange, housekeeping
+from logs import setup_logging, decision
+from accounts import Account, AccountFilter, current, load_account_configs, run_as, set_default
 
 from dotenv import load_dotenv
 
@@ -15,13 +31,89 @@ load_dotenv()
 api_key = os.getenv('API_KEY')
 secret = os.getenv('SECRET')
 
-def count_sig_digits(precision):
-    # Count digits after decimal point if it's a fraction
-    if precision < 1:
-        return abs(int(round(math.log10(precision))))
-    else:
-        return 1  # Treat whole numbers like 1, 10, 100 as 1 sig digit
-    
+# 0 keeps the old one-position-at-a-time loop, N > 0 fans positions out to N workers
+POSITION_WORKERS = int(os.getenv('POSITION_WORKERS', '0'))
+# Seconds between stop-loss ticks, and how long a tick may spend on positions
+TICK_INTERVAL = float(os.getenv('TICK_INTERVAL', '10'))
+TICK_BUDGET = float(os.getenv('TICK_BUDGET', '8'))
+# Seconds between trailing-state cleanup / orphan order passes
+CLEANUP_INTERVAL = float(os.getenv('CLEANUP_INTERVAL', '60'))
+# 'rest' polls every 10s, 'stream' reacts to a live position/mark/order feed
+FEED_MODE = os.getenv('FEED_MODE', 'rest')
+# Stream mode can be fed from a recorded file or a local JSON-lines server instead of Phemex
+FEED_REPLAY = os.getenv('FEED_REPLAY')
+FEED_ADDRESS = os.getenv('FEED_ADDRESS')
+# Seconds before market metadata is reloaded from the exchange
+MARKETS_TTL = float(os.getenv('MARKETS_TTL', '3600'))
+# Markets are saved here on every load; a restart trades on them right away and checks them against
+# the exchange in the background. Older than MARKETS_SNAPSHOT_MAX_AGE seconds is too old, empty turns it off
+MARKETS_SNAPSHOT = os.getenv('MARKETS_SNAPSHOT', 'markets-{exchange}.json')
+MARKETS_SNAPSHOT_MAX_AGE = float(os.getenv('MARKETS_SNAPSHOT_MAX_AGE', '86400'))
+# Request weight an account may spend in one burst, and how often / from what delay (seconds, doubling,
+# jittered) calls failing on a 429 or network error are retried
+RATE_BURST = float(os.getenv('RATE_BURST', '10'))
+REQUEST_RETRIES = int(os.getenv('REQUEST_RETRIES', '3'))
+REQUEST_BACKOFF = float(os.getenv('REQUEST_BACKOFF', '0.5'))
+# 'loop' walks positions one by one, 'vector' decides for all of them in one NumPy pass
+RISK_MODE = os.getenv('RISK_MODE', 'loop')
+# Seconds before an order book the orphan check hasn't seen change is read again, and how many per pass
+ORDERS_RESYNC = float(os.getenv('ORDERS_RESYNC', '3600'))
+ORDERS_RESYNC_BATCH = int(os.getenv('ORDERS_RESYNC_BATCH', '20'))
+# Serve Prometheus metrics on this port and/or dump them as JSON to this file every METRICS_INTERVAL seconds
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '60'))
+# DEBUG brings back the per-position dumps; 'json' writes one JSON record per line
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# JSON list of accounts to run side by side in this process (see accounts.load_account_configs);
+# unset runs the single API_KEY / SECRET account
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE')
+# 'exchange' rests every trailing stop on Phemex; 'local' trails it in memory against live marks and
+# closes at market on a breach, leaving only the first stop placed for a position on the exchange as a backstop
+STOP_MODE = os.getenv('STOP_MODE', 'exchange')
+# How far threshold and profit target step on every stop move; local moves cost no orders, so can step finer
+TRAIL_STEP = float(os.getenv('TRAIL_STEP', '0.10'))
+# 'step' moves the stop in TRAIL_STEP jumps as profit crosses each threshold. 'percent', 'atr' and 'fixed'
+# keep it TRAIL_DISTANCE (a fraction of price, ATRs, or price units) behind the best mark the position has
+# seen, and move it once it improves by TRAIL_MIN_TICKS ticks. A distance in price units only suits symbols
+# trading at similar prices, so 'fixed' has no default
+TRAIL_MODE = os.getenv('TRAIL_MODE', 'step')
+if TRAIL_MODE not in TRAIL_MODES + ('step',):
+    raise ValueError(f"Unknown TRAIL_MODE {TRAIL_MODE!r}, expected one of step, {', '.join(TRAIL_MODES)}")
+if TRAIL_MODE == 'fixed' and not os.getenv('TRAIL_DISTANCE'):
+    raise ValueError("TRAIL_MODE=fixed needs TRAIL_DISTANCE, in price units")
+TRAIL_DISTANCE = float(os.getenv('TRAIL_DISTANCE') or {'atr': '2'}.get(TRAIL_MODE, '0.01'))
+TRAIL_MIN_TICKS = int(os.getenv('TRAIL_MIN_TICKS', '1'))
+# Candles kept per symbol for ATR, volatility and VWAP: timeframe, how many, and the rolling window
+CANDLE_TIMEFRAME = os.getenv('CANDLE_TIMEFRAME', '15m')
+CANDLE_HISTORY = int(os.getenv('CANDLE_HISTORY', '500'))
+CANDLE_WINDOW = int(os.getenv('CANDLE_WINDOW', '14'))
+
+log = logging.getLogger('cryptsel')
+
+# Trailing state a position starts from before its first stop move
+DEFAULT_TRAILING = {'threshold': 0.10, 'profit_target_distance': 0.06}
+# Re-entry limit sits this far from liquidation towards entry, sized at this multiple of the notional
+REENTRY_FRACTION = 0.2
+REENTRY_NOTIONAL_MULTIPLIER = 1.5
+# 'fixed' uses the two settings above as they are. 'volatility' moves the limit REENTRY_ATR ATRs from the
+# mark (never nearer liquidation than the fixed level) and shrinks the size, down to REENTRY_MIN_SCALE of it,
+# when per-candle volatility runs above REENTRY_TARGET_VOL
+REENTRY_MODE = os.getenv('REENTRY_MODE', 'fixed')
+REENTRY_ATR = float(os.getenv('REENTRY_ATR', '3'))
+REENTRY_TARGET_VOL = float(os.getenv('REENTRY_TARGET_VOL', '0.01'))
+REENTRY_MIN_SCALE = 0.25
+# Re-entries are fitted into free margin, less MARGIN_BUFFER of it, and under MAX_SYMBOL_NOTIONAL /
+# MAX_TOTAL_NOTIONAL USDT (0 = no cap); one that can't keep REENTRY_MIN_FIT of its size is skipped
+MARGIN_BUFFER = float(os.getenv('MARGIN_BUFFER', '0.05'))
+MAX_SYMBOL_NOTIONAL = float(os.getenv('MAX_SYMBOL_NOTIONAL', '0'))
+MAX_TOTAL_NOTIONAL = float(os.getenv('MAX_TOTAL_NOTIONAL', '0'))
+REENTRY_MIN_FIT = float(os.getenv('REENTRY_MIN_FIT', '0.25'))
+
+# API calls, latencies and stage timings for the whole process
+metrics = Metrics()
+
 def round_to_sig_figs(num, sig_figs):
     if num == 0:
         return 0
@@ -31,64 +123,81 @@ def round_to_sig_figs(num, sig_figs):
 def calculateLiquidationTargPrice(_liqprice, _entryprice, _percnt, _round):
     return round_to_sig_figs(_entryprice + (_liqprice - _entryprice) * _percnt, _round)
 
-def reEnterTrade(exchange, symbol, order_side, order_price, order_amount, order_type):
-    try:
-        # Check if symbol is futures (adjust this check to your actual symbol format)
-        if ":USDT" not in symbol:
-            print(f"Skipping re-entry order for non-futures symbol: {symbol}")
-            return
+def volatility_reentry(exchange, symbol, side, mark_price, price, amount):
+    # REENTRY_MODE=volatility: widen the fixed re-entry by the market's ATR and
+    # size it down in rough markets; the fixed level is kept without candles
+    stats = get_candle_cache(exchange).indicators(exchange, symbol)
+    if stats is None or not stats.atr:
+        return price, amount
+    sign = 1 if side == 'long' else -1
+    target = mark_price - sign * REENTRY_ATR * stats.atr
+    volatile_price = max(target, price) if side == 'long' else min(target, price)
+    scale = min(1.0, max(REENTRY_MIN_SCALE, REENTRY_TARGET_VOL / stats.volatility)) if stats.volatility else 1.0
+    log.debug("%s re-entry with ATR %.6g, volatility %.4f, VWAP %s: %s -> %s, size x%.2f",
+              symbol, stats.atr, stats.volatility, stats.vwap, price, volatile_price, scale)
+    return volatile_price, amount * scale
+
+def new_exposure_model(exchange, snapshot):
+    # One per tick; a snapshot without a balance (stream mode) fetches it only if a re-entry comes up
+    return ExposureModel.from_snapshot(
+        snapshot, lambda: exchange.fetch_balance({'type': 'swap'}),
+        margin_buffer=MARGIN_BUFFER, max_symbol_notional=MAX_SYMBOL_NOTIONAL,
+        max_total_notional=MAX_TOTAL_NOTIONAL, min_fit=REENTRY_MIN_FIT,
+    )
+
+def reEnterTrade(exchange, symbol, order_side, order_price, order_amount, order_type, snapshot=None, gateway=None, exposure=None):
+    # Check if symbol is futures (adjust this check to your actual symbol format)
+    if ":USDT" not in symbol:
+        decision(log, 'skip_reentry', symbol, order_side, f"Skipping re-entry order for non-futures symbol: {symbol}",
+                 level=logging.DEBUG, reason='not_futures')
+        return
 
-        # Fetch balance once
-        balance_info = exchange.fetch_balance({'type': 'swap'})
-        usdt_balance = balance_info.get('USDT', {}).get('free', 0)
-        
-        estimated_cost = order_amount * order_price
-        
-        # if usdt_balance < estimated_cost:
-        #     print(f"⚠️ Insufficient USDT balance ({usdt_balance}) for order cost ({estimated_cost}). Skipping order.")
-        #     return
-        
-        # First attempt: without posSide (works in one-way mode)
-        order = exchange.create_order(
-            symbol=symbol,
-            type=order_type,
-            side=order_side,
-            amount=order_amount,
-            price=order_price,
-            params={
-                'reduceOnly': False
-            }
-        )
-        print(f"✅ Re-entry order placed: {order_side} {order_amount} @ {order_price}")
-        
-    except ccxt.BaseError as e:
-        error_msg = str(e)
-        # Handle specific phemex error for pilot contract
-        if 'Pilot contract is not allowed here' in error_msg:
-            print(f"❌ Phemex error: Pilot contract is not allowed for {symbol}. Skipping order.")
-            return
-        
-        # If failed due to position mode, retry with posSide
-        if 'TE_ERR_INCONSISTENT_POS_MODE' in error_msg:
-            print("🔁 Retrying with (Limit) posSide due to inconsistent position mode...")
-            pos_side = 'Long' if order_side == 'buy' else 'Short'
-            try:
-                order = exchange.create_order(
-                    symbol=symbol,
-                    type=order_type,
-                    side=order_side,
-                    amount=order_amount,
-                    price=order_price,
-                    params={
-                        'reduceOnly': False,
-                        'posSide': pos_side
-                    }
-                )
-                print(f"✅ Re-entry Limit order (with posSide) placed: {order_side} {order_amount} @ {order_price}")
-            except ccxt.BaseError as e2:
-                print(f"❌ Re-entry Limit order failed even with posSide: {e2}")
-        else:
-            print(f"❌ Error placing re-entry Limit order: {e}")
+    # Outside a tick the order gets a model of its own
+    if exposure is None:
+        exposure = new_exposure_model(exchange, snapshot if snapshot is not None else AccountSnapshot([]))
+    market = get_market_cache(exchange).get(symbol)
+    contract_size = market.contract_size if market is not None else 1.0
+    pos_side = 'long' if order_side == 'buy' else 'short'
+
+    # Take what still fits next to everything else planned this tick
+    wanted = order_amount
+    reserved = exposure.reserve(symbol, pos_side, order_price, order_amount, contract_size)
+    order_amount = reserved
+    if 0 < order_amount < wanted and market is not None and market.lot_size:
+        order_amount = round(math.floor(order_amount / market.lot_size) * market.lot_size, market.amount_sig_digits)
+    if order_amount <= 0:
+        exposure.release(symbol, pos_side, order_price, reserved, contract_size)
+        decision(log, 'skip_reentry', symbol, order_side,
+                 f"⚠️ Not enough margin for a re-entry of {wanted} on {symbol}. Skipping order.",
+                 reason='margin', wanted=wanted, price=order_price, available=exposure.available())
+        return
+    if order_amount < wanted:
+        log.info("📉 Re-entry on %s scaled down from %s to %s to fit the free margin", symbol, wanted, order_amount)
+
+    def on_placed(future):
+        try:
+            future.result()
+            decision(log, 'reenter', symbol, order_side, f"✅ Re-entry order placed: {order_side} {order_amount} @ {order_price}",
+                     price=order_price, amount=order_amount, wanted=wanted, type=order_type, available=exposure.available())
+        except Exception as e:
+            exposure.release(symbol, pos_side, order_price, reserved, contract_size)
+            # Handle specific phemex error for pilot contract
+            if 'Pilot contract is not allowed here' in str(e):
+                log.warning("❌ Phemex error: Pilot contract is not allowed for %s. Skipping order.", symbol)
+            else:
+                log.error("❌ Error placing re-entry Limit order for %s: %s", symbol, e)
+
+    immediate = gateway is None
+    if immediate:
+        gateway = new_order_gateway(exchange)
+    # posSide comes from the symbol's known position mode
+    gateway.create(
+        symbol, order_type, order_side, order_amount, order_price,
+        params={'reduceOnly': False},
+        pos_side=pos_side,
+    ).add_done_callback(on_placed)
+    if immediate:
+        gateway.flush()
 
             
 def get_position(exchange, symbol):
@@ -98,75 +207,80 @@ def get_position(exchange, symbol):
             return p
     return None
     
-def cancel_orphan_orders(exchange, all_symbols, order_type):
+@metrics.timed()
+def cancel_orphan_orders(exchange, all_symbols, order_type, snapshot=None, gateway=None):
+    order_index = current().order_index
+    position_modes = current().position_modes
+    immediate = gateway is None
+    if immediate:
+        gateway = new_order_gateway(exchange)
+
+    def cancel(order, symbol):
+        def on_cancelled(future):
+            error = future.exception()
+            if isinstance(error, ccxt.OrderNotFound):
+                # Already gone from the book, nothing left to cancel
+                order_index.forget(order['id'])
+            elif error:
+                log.error("Error cancelling order %s on %s: %s", order['id'], symbol, error)
+                order_index.touch(symbol)
+
+        # The order itself tells us which mode its symbol is in
+        position_modes.learn(symbol, order.get('info'))
+        gateway.cancel(
+            order['id'], symbol,
+            pos_side='long' if order['side'].lower() == 'buy' else 'short',
+        ).add_done_callback(on_cancelled)
+
     try:
         positions_map = {}
         try:
-            # Fetch positions for all symbols once
-            all_positions = exchange.fetch_positions(symbols=all_symbols)
-            for p in all_positions:
-                symbol = p['symbol']
-                contracts = float(p.get('contracts') or p.get('size') or 0)
-                side = p.get('side', '').lower()
-                positions_map[symbol] = {
-                    'has_position': contracts > 0,
-                    'side': side
-                }
+            if snapshot is not None:
+                positions_map = snapshot.positions_map()
+            else:
+                # Fetch positions for all symbols once
+                positions_map = AccountSnapshot(exchange.fetch_positions(symbols=all_symbols)).positions_map()
         except Exception as e:
-            print("Error fetching positions:", e)
+            log.error("Error fetching positions: %s", e)
             return
 
-        for symbol in all_symbols:
+        # Books the snapshot has are fresh; otherwise only symbols we've never
+        # read (or not for ORDERS_RESYNC seconds) cost a fetch
+        if snapshot is not None:
+            order_index.load_all({symbol: snapshot.open_orders(symbol) for symbol in all_symbols})
+        for symbol in order_index.stale(all_symbols, ORDERS_RESYNC, ORDERS_RESYNC_BATCH):
             try:
-                open_orders = exchange.fetch_open_orders(symbol)
-                if not open_orders:
-                    continue
-
-                position_info = positions_map.get(symbol, {'has_position': False, 'side': None})
-                has_position = position_info['has_position']
-                current_side = position_info['side']
-
-                for order in open_orders:
-                    if order['type'] != order_type:
-                        continue
-
-                    order_side = order['side'].lower()  # 'buy' or 'sell'
-
-                    # Cancel all limit orders if no position exists
-                    if not has_position:
-                        print(f"❌ Cancelling orphaned {order_side.upper()} {order_type} order for {symbol} (no position)")
-                        try:
-                            exchange.cancel_order(order['id'], symbol)
-                        except Exception as e:
-                            if "TE_ERR_INCONSISTENT_POS_MODE" in str(e):
-                                pos_side_str = "Long" if order_side == "buy" else "Short"
-                                print(f"Retrying cancel with posSide={pos_side_str}")
-                                exchange.cancel_order(order['id'], symbol, {'posSide': pos_side_str})
-                            else:
-                                print(f"Error cancelling order: {e}")
-                        continue
-
-                    # Cancel limit orders that do not match the position side
-                    if (order_side == 'buy' and current_side != 'long') or (order_side == 'sell' and current_side != 'short'):
-                        print(f"⚠️ Cancelling mismatched {order_side.upper()} {order_type} order for {symbol} (position side: {current_side})")
-                        try:
-                            exchange.cancel_order(order['id'], symbol)
-                        except Exception as e:
-                            if "TE_ERR_INCONSISTENT_POS_MODE" in str(e):
-                                pos_side_str = "Long" if order_side == "buy" else "Short"
-                                print(f"Retrying cancel with posSide={pos_side_str}")
-                                exchange.cancel_order(order['id'], symbol, {'posSide': pos_side_str})
-                            else:
-                                print(f"Error cancelling order: {e}")
-
+                order_index.load(symbol, exchange.fetch_open_orders(symbol))
             except Exception as e:
-                print(f"Error handling {symbol}: {e}")
+                log.error("Error handling %s: %s", symbol, e)
+
+        # Only symbols whose orders or position changed since the last pass are looked at
+        order_index.set_positions(positions_map, all_symbols)
+        for order, reason in order_index.reconcile(order_type, all_symbols):
+            symbol = order['symbol']
+            order_side = order['side'].lower()  # 'buy' or 'sell'
+            if reason == 'orphan':
+                # Cancel all limit orders if no position exists
+                decision(log, 'cancel_orphan', symbol, order_side,
+                         f"❌ Cancelling orphaned {order_side.upper()} {order_type} order for {symbol} (no position)",
+                         order_id=order['id'], price=order.get('price'), amount=order.get('amount'))
+            else:
+                # Cancel limit orders that do not match the position side
+                current_side = positions_map[symbol]['side']
+                decision(log, 'cancel_mismatched', symbol, order_side,
+                         f"⚠️ Cancelling mismatched {order_side.upper()} {order_type} order for {symbol} (position side: {current_side})",
+                         order_id=order['id'], price=order.get('price'), amount=order.get('amount'), position_side=current_side)
+            cancel(order, symbol)
+
+        if immediate:
+            gateway.flush()
 
     except Exception as e:
-        print(f"Global error in cancel_orphan_orders: {e}")
+        log.exception("Global error in cancel_orphan_orders: %s", e)
 
         
-def monitor_position_and_reenter(exchange, symbol, position):
+@metrics.timed()
+def monitor_position_and_reenter(exchange, symbol, position, snapshot=None, gateway=None, exposure=None):
     try:
         if position:
             # print(json.dumps(position, indent = 4))
@@ -176,12 +290,14 @@ def monitor_position_and_reenter(exchange, symbol, position):
             contracts = float(position.get('contracts') or 0)
             leverage = float(position.get("leverage") or 1)
             notional = float(position.get('notional') or 0)
-            price_precision_val = exchange.markets[symbol]['precision']['price']
-            price_sig_digits = count_sig_digits(price_precision_val)
-            amount_precision_val = exchange.markets[symbol]['precision']['amount']
-            amount_sig_digits = count_sig_digits(amount_precision_val)
+            market = get_market_cache(exchange).get(symbol)
+            if market is None:
+                log.warning("⚠️ No market metadata for %s, skipping", symbol)
+                return
+            price_sig_digits = market.price_sig_digits
+            amount_sig_digits = market.amount_sig_digits
             side = position.get('side').lower()  # typically 'long' or 'short'
-            fromPercnt = 0.2  #20%
+            fromPercnt = REENTRY_FRACTION
             if not liquidation_price or not entry_price or not mark_price:
                 return  # Skip if essential data is missing
             # Calculate how far the price has moved toward liquidation.
@@ -189,106 +305,311 @@ def monitor_position_and_reenter(exchange, symbol, position):
                 closeness = 1 - (abs(mark_price - liquidation_price) / abs(entry_price - liquidation_price))
             else:  # short
                 closeness = 1 - (abs(mark_price - liquidation_price) / abs(entry_price - liquidation_price))
-            print(f"\n--- {symbol} ---")
-            print(f"Side: {side}")
-            print(f"Entry Price: {entry_price}")
-            print(f"Mark Price: {mark_price}")
-            print(f"Liquidation Price: {liquidation_price}")
-            print(f"Closeness to Liquidation: {closeness * 100:.2f}%")
-            # Fetch all open orders
-            open_orders = exchange.fetchOpenOrders(symbol)
+            log.debug("--- %s --- side %s, entry %s, mark %s, liquidation %s, closeness to liquidation %.2f%%",
+                      symbol, side, entry_price, mark_price, liquidation_price, closeness * 100)
+            # Fetch all open orders unless the tick's snapshot already has them
+            open_orders = snapshot.open_orders(symbol) if snapshot is not None else None
+            if open_orders is None:
+                open_orders = exchange.fetchOpenOrders(symbol)
             side_str = 'buy' if side == 'long' else 'sell' # smae side
             has_same_side_limit = any(
                 o['type'] == 'limit' and o['side'] == side_str for o in open_orders
             )
             if has_same_side_limit:
-                print("Same-side limit order already exists. Doing nothing.")
+                decision(log, 'skip_reentry', symbol, side, f"Same-side limit order already exists on {symbol}. Doing nothing.",
+                         level=logging.DEBUG, reason='same_side_limit')
                 return
-            print("Open Orders: ", open_orders)
+            log.debug("Open Orders on %s: %s", symbol, open_orders)
             # call on rentry function
             order_side = 'sell' if side == 'short' else 'buy'
             order_price = mark_price
-            double_notional = notional * 1.5
+            double_notional = notional * REENTRY_NOTIONAL_MULTIPLIER
             order_amount = double_notional / mark_price
-            order_amount = round_to_sig_figs(order_amount, amount_sig_digits)
             order_type = 'limit'
             triggerPrice = calculateLiquidationTargPrice(entry_price, liquidation_price, fromPercnt, price_sig_digits)
-            print("Trigger Price: ", triggerPrice, " and Order Amount: ", order_amount)
-            reEnterTrade(exchange, symbol, order_side, triggerPrice, order_amount, order_type)
+            if REENTRY_MODE == 'volatility':
+                triggerPrice, order_amount = volatility_reentry(exchange, symbol, side, mark_price, triggerPrice, order_amount)
+                triggerPrice = round_to_sig_figs(triggerPrice, price_sig_digits)
+            order_amount = round_to_sig_figs(order_amount, amount_sig_digits)
+            log.debug("%s trigger price %s and order amount %s", symbol, triggerPrice, order_amount)
+            reEnterTrade(exchange, symbol, order_side, triggerPrice, order_amount, order_type, snapshot, gateway, exposure)
             # Trigger re-entry logic if close to liquidation
             if closeness >= 0.8:
-                print("⚠️  Mark price is 80% close to liquidation! Considering re-entry...")
+                log.info("⚠️  %s mark price is 80%% close to liquidation! Considering re-entry...", symbol)
             else:
-                print("✅ Not close enough to liquidation for re-entry.")
+                log.debug("✅ %s not close enough to liquidation for re-entry.", symbol)
         else:
-            print(f"No open{symbol} positions found.")
+            log.debug("No open %s positions found.", symbol)
     except ccxt.ExchangeError as e:
-        print(f"Exchange error: {e}")
+        log.error("Exchange error on %s: %s", symbol, e)
     except KeyError as ke:
-        print(f"Missing key: {ke}")
-    time.sleep(1)
+        log.error("Missing key on %s: %s", symbol, ke)
 
 TRAILING_FOLDER = "trailProfit"
 TRAILING_ORDER_FOLDER = "tradeOrder"
+# Single SQLite file holding the trailing state of every position
+TRAILING_DB = os.getenv('TRAILING_DB', 'trailing.db')
+# Orders, fills and stop moves, with realized PnL per position (python journal.py for a summary)
+JOURNAL_DB = os.getenv('JOURNAL_DB', 'journal.db')
 
-# Ensure base folders exist
-os.makedirs(os.path.join(TRAILING_FOLDER, "buy"), exist_ok=True)
-os.makedirs(os.path.join(TRAILING_FOLDER, "sell"), exist_ok=True)
 os.makedirs(TRAILING_ORDER_FOLDER, exist_ok=True)
 
 
 def safe_filename(symbol):
     return symbol.replace('/', '_').replace(':', '_')
 
+def filename_to_symbol(filename):
+    # Example input: "JELLYJELLY_USDT_USDT.json"
+    parts = filename.replace(".json", "").split("_")
+    if len(parts) < 3:
+        return None
+    base = parts[0]  # e.g. "JELLYJELLY"
+    quote = parts[1]  # e.g. "USDT"
+    return f"{base}/{quote}:USDT"
+
+def open_trailing_store(path):
+    store = TrailingStore(path)
+    # Pull in state left behind by the old per-symbol JSON files, once. Never
+    # into a throwaway store (bench, backtest): the files are removed after.
+    if path != ':memory:' and os.path.isdir(TRAILING_FOLDER):
+        for filepath in store.import_json_folder(TRAILING_FOLDER, filename_to_symbol):
+            os.remove(filepath)
+            log.info("📦 Migrated trailing file %s into %s", filepath, path)
+    return store
+
+def new_account(name, exchange, trailing_db, credentials=None, exchange_id='phemex', journal_db=JOURNAL_DB):
+    store = open_trailing_store(trailing_db)
+    atexit.register(store.close)
+    journal = Journal(journal_db)
+    atexit.register(journal.close)
+    return Account(name, exchange, store, credentials, exchange_id, journal)
+
+if not ACCOUNTS_FILE:
+    # Single-account mode: everything runs for this account; __main__ gives it its exchange
+    set_default(new_account('default', None, TRAILING_DB, {'apiKey': api_key, 'secret': secret}))
+
+
 def load_trailing_data(symbol, side):
-    filename = f"{safe_filename(symbol)}.json"
-    subfolder = 'buy' if side == 'long' else 'sell'
-    filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
-    return None
+    return current().trailing_store.get(symbol, side)
 
 
 def save_trailing_data(symbol, data, side):
-    filename = f"{safe_filename(symbol)}.json"
-    subfolder = 'buy' if side == 'long' else 'sell'
-    filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
     data['side'] = 'buy' if side == 'long' else 'sell'
-    with open(filepath, "w") as f:
-        json.dump(data, f, indent=4)
+    current().trailing_store.set(symbol, side, data)
 
 
-def delete_trailing_data(symbol):
-    filename = f"{safe_filename(symbol)}.json"
-    deleted = False
-    for subfolder in ['buy', 'sell']:
-        filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🗑️ Deleted trailing data for {symbol} from {subfolder} folder")
-            deleted = True
-    if not deleted:
-        print(f"⚠️ No trailing data found to delete for {symbol}")
+def delete_trailing_data(symbol, side=None):
+    # Both sides unless one is given; hedge-mode legs trail independently
+    deleted = current().trailing_store.delete(symbol, side)
+    if deleted:
+        log.info("🗑️ Deleted trailing data for %s%s", symbol, f" ({side})" if side else "")
+    else:
+        log.debug("⚠️ No trailing data found to delete for %s", symbol)
     return deleted
 
 
 def reset_trailing_data(symbol=None):
+    trailing_store = current().trailing_store
     if symbol:
-        filepath = os.path.join(TRAILING_FOLDER, f"{symbol.replace('/', '_')}.json")
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🧹 Trailing data reset for {symbol}. File deleted.")
+        if trailing_store.delete(symbol):
+            log.info("🧹 Trailing data reset for %s.", symbol)
         else:
-            print(f"🧹 No trailing data file found for {symbol}. Nothing to delete.")
+            log.info("🧹 No trailing data found for %s. Nothing to delete.", symbol)
     else:
-        for filename in os.listdir(TRAILING_FOLDER):
-            filepath = os.path.join(TRAILING_FOLDER, filename)
-            os.remove(filepath)
-        print("🧹 All trailing data reset. All files deleted.")
+        trailing_store.clear()
+        log.info("🧹 All trailing data reset.")
+    trailing_store.flush()
+
+def stop_loss_params(side, stop_price):
+    # posSide is added by the order gateway from the symbol's position mode
+    return {
+        'stopPx': stop_price,
+        'triggerType': 'ByLastPrice',
+        'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
+        'reduceOnly': True,
+        'closeOnTrigger': True,
+        'timeInForce': 'GoodTillCancel',
+    }
+
+def drop_trailing_stop(gateway, symbol, side, order_id):
+    # The position gave its profit back: pull the stop and forget the trailing state
+    if order_id:
+        def on_cancelled(future):
+            if future.exception():
+                log.error("⚠️ Failed to cancel stop-loss %s on %s: %s", order_id, symbol, future.exception())
+            else:
+                log.info("❌ Canceled previous stop-loss %s on %s", order_id, symbol)
+
+        gateway.cancel(order_id, symbol, pos_side=side).add_done_callback(on_cancelled)
+
+    current().triggers.disarm(symbol, side)
+    if delete_trailing_data(symbol, side) or order_id:
+        current().journal.record_stop(symbol, side, 'drop', order_id=order_id)
+        decision(log, 'drop_stop', symbol, side, f"Dropping trailing stop on {symbol} ({side})", order_id=order_id)
+
+def move_trailing_stop(gateway, symbol, side, contracts, new_stop_price, trailing_data, breath_threshold):
+    if STOP_MODE == 'local':
+        arm_local_stop(gateway, symbol, side, contracts, new_stop_price, trailing_data, breath_threshold)
+        return
+
+    threshold = trailing_data['threshold']
+    profit_target_distance = trailing_data['profit_target_distance']
+
+    # ✅ Save updated trailing data once the exchange has the new stop
+    def on_moved(future):
+        try:
+            order = future.result()
+        except Exception as e:
+            log.error("❌ Failed to place stop-loss for %s: %s", symbol, e)
+            return
+        log.info("✅ Placed new stop-loss at %.4f for %s", new_stop_price, symbol)
+        current().journal.record_stop(symbol, side, 'move', new_stop_price, order['id'],
+                                      previous=trailing_data.get('stopPrice'))
+        trailing_data['orderId'] = order['id']
+        trailing_data['stopPrice'] = new_stop_price
+        trailing_data['profit_target_distance'] = profit_target_distance + breath_threshold
+        trailing_data['threshold'] = threshold + breath_threshold
+        trailing_data['order_updated'] = True
+        save_trailing_data(symbol, trailing_data, side)
+
+    # Amend (or replace) the old stop in the symbol's position mode
+    gateway.move_stop(
+        trailing_data.get('orderId'), symbol, 'sell' if side == 'long' else 'buy', contracts, new_stop_price,
+        stop_loss_params(side, new_stop_price), pos_side=side,
+    ).add_done_callback(on_moved)
+
+def arm_local_stop(gateway, symbol, side, contracts, new_stop_price, trailing_data, breath_threshold):
+    # Local mode: the new level lives in memory (and in the trailing state, for
+    # restarts) and moves without an order. The exchange only gets the first
+    # stop of a position, which stays put as a backstop should we go away.
+    current().triggers.arm(symbol, side, new_stop_price, contracts)
+    current().journal.record_stop(symbol, side, 'local', new_stop_price, previous=trailing_data.get('localStop'))
+    trailing_data['localStop'] = new_stop_price
+    trailing_data['profit_target_distance'] += breath_threshold
+    trailing_data['threshold'] += breath_threshold
+    trailing_data['order_updated'] = True
+    save_trailing_data(symbol, trailing_data, side)
+    log.info("✅ Local stop-loss for %s now at %.4f", symbol, new_stop_price)
+    if trailing_data.get('orderId'):
+        return
+
+    def on_placed(future):
+        try:
+            order = future.result()
+        except Exception as e:
+            log.error("❌ Failed to place backstop for %s, it is watched locally only: %s", symbol, e)
+            return
+        log.info("✅ Placed backstop at %.4f for %s", new_stop_price, symbol)
+        current().journal.record_stop(symbol, side, 'backstop', new_stop_price, order['id'])
+        trailing_data['orderId'] = order['id']
+        save_trailing_data(symbol, trailing_data, side)
+
+    gateway.move_stop(
+        None, symbol, 'sell' if side == 'long' else 'buy', contracts, new_stop_price,
+        stop_loss_params(side, new_stop_price), pos_side=side,
+    ).add_done_callback(on_placed)
+
+def cancel_reentry_limits(gateway, symbol, side):
+    # Re-entry limits of a position we just closed would open a new one with no stop behind it
+    order_index = current().order_index
+    for order in order_index.open_orders(symbol, 'buy' if side == 'long' else 'sell'):
+        if order.get('type') != 'limit' or order.get('reduceOnly'):
+            continue
+
+        def on_cancelled(future, order_id=order['id']):
+            error = future.exception()
+            if isinstance(error, ccxt.OrderNotFound):
+                order_index.forget(order_id)
+            elif error:
+                log.error("⚠️ Failed to cancel re-entry limit %s on %s: %s", order_id, symbol, error)
+                order_index.touch(symbol)
+
+        gateway.cancel(order['id'], symbol, pos_side=side).add_done_callback(on_cancelled)
+
+def close_at_local_stop(exchange, trigger, mark_price):
+    # Sent on its own gateway and flushed right away: a breached stop never
+    # waits behind the rest of the tick's orders. If the close fails the
+    # trailing state still holds the level and the next pass arms it again.
+    # True once the position is closed.
+    symbol, side = trigger.symbol, trigger.side
+    decision(log, 'local_stop', symbol, side,
+             f"🛑 {symbol} ({side}) marked {mark_price} through its local stop at {trigger.stop_price:.4f}, closing at market",
+             mark=mark_price, stop=trigger.stop_price, contracts=trigger.contracts)
+    current().journal.record_stop(symbol, side, 'fired', trigger.stop_price, mark=mark_price)
+    gateway = new_order_gateway(exchange)
+    closed = gateway.create(
+        symbol, 'market', 'sell' if side == 'long' else 'buy', trigger.contracts, None,
+        {'reduceOnly': True}, pos_side=side,
+    )
+    gateway.flush()
+    try:
+        closed.result()
+    except Exception as e:
+        log.error("❌ Failed to close %s (%s) at its local stop: %s", symbol, side, e)
+        return False
+    trailing_data = load_trailing_data(symbol, side) or {}
+    drop_trailing_stop(gateway, symbol, side, trailing_data.get('orderId'))
+    cancel_reentry_limits(gateway, symbol, side)
+    gateway.flush()
+    current().trailing_store.flush()
+    return True
+
+def fire_local_stops(exchange, symbol, mark_price):
+    # Every mark we see for a held symbol goes through here in local mode;
+    # returns the sides closed
+    return [
+        trigger.side for trigger in current().triggers.check(symbol, mark_price)
+        if close_at_local_stop(exchange, trigger, mark_price)
+    ]
+
+def local_stop_hit(exchange, position):
+    # (Re-)arms the position's local stop from its trailing state, so a restart
+    # or a change in size is picked up, and closes it if the mark is through it
+    symbol = position.get('symbol')
+    side = (position.get('side') or '').lower()
+    mark_price = float(position.get('markPrice') or 0)
+    trailing_data = load_trailing_data(symbol, side)
+    if not mark_price or not trailing_data or trailing_data.get('localStop') is None:
+        return False
+    triggers = current().triggers
+    triggers.arm(symbol, side, trailing_data['localStop'], float(position.get('contracts') or 0))
+    fired = triggers.check(symbol, mark_price, side)
+    for trigger in fired:
+        close_at_local_stop(exchange, trigger, mark_price)
+    return bool(fired)
+
+def symbol_atr(exchange, symbol):
+    stats = get_candle_cache(exchange).indicators(exchange, symbol)
+    return stats.atr if stats is not None else None
+
+def stop_key():
+    # Trailing-state key of the stop we manage: the local trigger in local mode, else the exchange stop
+    return 'localStop' if STOP_MODE == 'local' else 'stopPrice'
+
+def ratchet_trailing_stop(exchange, gateway, symbol, side, entry_price, mark_price, contracts, trailing_data):
+    # Continuous trailing: follow the high-water mark, kept in the trailing state
+    hwm = high_water_mark(side, trailing_data.get('hwm'), mark_price)
+    info = get_market_cache(exchange).get(symbol)
+    new_stop_price = ratchet(
+        side, entry_price, mark_price, hwm, trailing_data.get(stop_key()), TRAIL_MODE, TRAIL_DISTANCE,
+        info.tick_size if info else None, TRAIL_MIN_TICKS,
+        symbol_atr(exchange, symbol) if TRAIL_MODE == 'atr' else None,
+    )
+    if hwm != trailing_data.get('hwm'):
+        trailing_data['hwm'] = hwm
+        save_trailing_data(symbol, trailing_data, side)
+    if new_stop_price is None:
+        return
+
+    decision(log, 'move_stop', symbol, side,
+             f"🔄 Trailing stop-loss on {symbol} to {new_stop_price:.4f}, high-water mark {hwm:.4f}",
+             entry=entry_price, mark=mark_price, hwm=hwm, stop=new_stop_price, contracts=contracts)
+    # Nothing to step: threshold and profit target only matter to step mode
+    move_trailing_stop(gateway, symbol, side, contracts, new_stop_price, trailing_data, 0)
 
 # The main trailing stop logic now loads/saves per symbol
-def trailing_stop_logic(exchange, position, breath_stop, breath_threshold):
+@metrics.timed()
+def trailing_stop_logic(exchange, position, breath_stop, breath_threshold, gateway=None):
     symbol = position.get('symbol')
     entry_price = float(position.get('entryPrice') or 0)
     mark_price = float(position.get('markPrice') or 0)
@@ -299,11 +620,11 @@ def trailing_stop_logic(exchange, position, breath_stop, breath_threshold):
     if not entry_price or not mark_price or side not in ['long', 'short'] or contracts <= 0:
         return
 
+    if STOP_MODE == 'local' and local_stop_hit(exchange, position):
+        # Closed at market (or being retried); nothing left to trail
+        return True
 
-    trailing_data = load_trailing_data(symbol, side) or {
-        'threshold': 0.10,
-        'profit_target_distance': 0.06
-    }
+    trailing_data = load_trailing_data(symbol, side) or dict(DEFAULT_TRAILING)
 
     threshold = trailing_data['threshold']
     profit_target_distance = trailing_data['profit_target_distance']
@@ -312,7 +633,6 @@ def trailing_stop_logic(exchange, position, breath_stop, breath_threshold):
     change = (mark_price - entry_price) / entry_price if side == 'long' else (entry_price - mark_price) / entry_price
     profit_distance = change * leverage
 
-    print("Leverage: ", leverage)
     unrealized_pnl = (mark_price - entry_price) * contracts if side == 'long' else (entry_price - mark_price) * contracts
     realized_pnl = float(position["info"].get('curTermRealisedPnlRv') or 0)
     addUnreRea = unrealized_pnl + realized_pnl
@@ -320,236 +640,478 @@ def trailing_stop_logic(exchange, position, breath_stop, breath_threshold):
     # unrealized_pnl_rounded = round_to_sig_figs(unrealized_pnl, 4)
     # realized_pnl_rounded = round_to_sig_figs(realized_pnl, 4)
 
-    print("\n\nUnrealized PnL:", unrealized_pnl)
-    print("Realized PnL:", realized_pnl)
-    print(f"Add unrpnl and reapnl: {addUnreRea}")
-    print("distance entry - last price (for profit):", profit_distance)
+    log.debug("%s %s leverage %s, unrealized PnL %s, realized PnL %s, total %s, profit distance %s",
+              symbol, side, leverage, unrealized_pnl, realized_pnl, addUnreRea, profit_distance)
+
+    immediate = gateway is None
+    if immediate:
+        gateway = new_order_gateway(exchange)
+    current().position_modes.learn(symbol, position.get('info'))
     
     if addUnreRea <= 0.001:
-        if order_id:
-            try:
-                # Try canceling without posSide param first (one-way mode)
-                exchange.cancel_order(order_id, symbol=symbol)
-                print(f"❌ Canceled previous stop-loss {order_id} without posSide")
-            except Exception as e:
-                error_msg = str(e)
-                # Check if error is related to inconsistent position mode
-                if "TE_ERR_INCONSISTENT_POS_MODE" in error_msg:
-                    try:
-                        # Retry with posSide param (hedge mode)
-                        params = {'posSide': 'Long' if side == 'long' else 'Short'}
-                        exchange.cancel_order(order_id, symbol=symbol, params=params)
-                        print(f"❌ Canceled previous stop-loss {order_id} with posSide param")
-                    except Exception as e2:
-                        print(f"⚠️ Failed to cancel stop-loss even with posSide: {e2}")
-                else:
-                    print(f"⚠️ Failed to cancel stop-loss: {e}")
-                    
-        delete_trailing_data(symbol)
+        drop_trailing_stop(gateway, symbol, side, order_id)
+        if immediate:
+            gateway.flush()
+        return
+
+    if TRAIL_MODE != 'step':
+        ratchet_trailing_stop(exchange, gateway, symbol, side, entry_price, mark_price, contracts, trailing_data)
+        if immediate:
+            gateway.flush()
         return
 
     if profit_distance >= threshold:
-        print(f"📈 Hello! {side.capitalize()} position on {symbol} is up {round(change * 100, 2)}%")
+        log.info("📈 Hello! %s position on %s is up %s%%", side.capitalize(), symbol, round(change * 100, 2))
         new_stop_price = entry_price * (1 + profit_target_distance / leverage) if side == 'long' else entry_price * (1 - profit_target_distance / leverage)
 
         if (side == 'long' and new_stop_price <= entry_price) or (side == 'short' and new_stop_price >= entry_price):
-            print(f"New stop loss @ {new_stop_price} is not valid relative to entry price @ {entry_price}")
+            log.warning("New stop loss on %s @ %s is not valid relative to entry price @ %s", symbol, new_stop_price, entry_price)
             return
 
-        print(f"🔄 Moving stop-loss to {round(profit_target_distance * 100, 2)}%, at price {new_stop_price:.4f}")
-
-        # ✅ Cancel old order if it exists
-        if order_id:
-            try:
-                # Try canceling without posSide param first (one-way mode)
-                exchange.cancel_order(order_id, symbol=symbol)
-                print(f"❌ Canceled previous stop-loss {order_id} without posSide")
-            except Exception as e:
-                error_msg = str(e)
-                # Check if error is related to inconsistent position mode
-                if "TE_ERR_INCONSISTENT_POS_MODE" in error_msg:
-                    try:
-                        # Retry with posSide param (hedge mode)
-                        params = {'posSide': 'Long' if side == 'long' else 'Short'}
-                        exchange.cancel_order(order_id, symbol=symbol, params=params)
-                        print(f"❌ Canceled previous stop-loss {order_id} with posSide param")
-                    except Exception as e2:
-                        print(f"⚠️ Failed to cancel stop-loss even with posSide: {e2}")
-                else:
-                    print(f"⚠️ Failed to cancel stop-loss: {e}")
-
-        order_created = False
-
-        # ✅ Try creating stop-loss in hedge mode
-        try:
-            order = exchange.create_order(
-                symbol=symbol,
-                type='stop',
-                side='sell' if side == 'long' else 'buy',
-                amount=contracts,
-                price=None,
-                params={
-                    'stopPx': new_stop_price,
-                    'triggerType': 'ByLastPrice',
-                    'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
-                    'positionIdx': 1 if side == 'long' else 2,
-                    'posSide': 'Long' if side == 'long' else 'Short',
-                    'closeOnTrigger': True,
-                    'reduceOnly': True,
-                    'timeInForce': 'GoodTillCancel',
-                }
-            )
-            print(f"✅ Placed new stop-loss at {new_stop_price:.4f} for {symbol}")
-            order_created = True
-        except Exception as e:
-            print(f"⚠️ Hedge mode failed: {e} — retrying in one-way mode")
-
-        # ✅ Fallback: one-way mode
-        if not order_created:
-            try:
-                order = exchange.create_order(
-                    symbol=symbol,
-                    type='stop',
-                    side='sell' if side == 'long' else 'buy',
-                    amount=contracts,
-                    price=None,
-                    params={
-                        'stopPx': new_stop_price,
-                        'triggerType': 'ByLastPrice',
-                        'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
-                        'reduceOnly': True,
-                        'closeOnTrigger': True,
-                        'timeInForce': 'GoodTillCancel',
-                    }
-                )
-                print(f"✅ Placed stop-loss in one-way mode at {new_stop_price:.4f} for {symbol}")
-                order_created = True
-            except Exception as e2:
-                print(f"❌ Failed again (one-way mode): {e2}")
-                return
-
-        # ✅ Save updated trailing data
-        if order_created:
-            trailing_data['orderId'] = order['id']
-            trailing_data['profit_target_distance'] = profit_target_distance + breath_threshold
-            trailing_data['threshold'] = threshold + breath_threshold
-            trailing_data['order_updated'] = True
-            save_trailing_data(symbol, trailing_data, side)
-
-def filename_to_symbol(filename):
-    # Example input: "JELLYJELLY_USDT_USDT.json"
-    parts = filename.replace(".json", "").split("_")
-    if len(parts) < 3:
-        return None
-    base = parts[0]  # e.g. "JELLYJELLY"
-    quote = parts[1]  # e.g. "USDT"
-    return f"{base}/{quote}:USDT"
-
-
-def cleanup_closed_trailing_files(exchange, symbols):
+        decision(log, 'move_stop', symbol, side,
+                 f"🔄 Moving stop-loss on {symbol} to {round(profit_target_distance * 100, 2)}%, at price {new_stop_price:.4f}",
+                 entry=entry_price, mark=mark_price, stop=new_stop_price, contracts=contracts, profit_distance=profit_distance)
+        move_trailing_stop(gateway, symbol, side, contracts, new_stop_price, trailing_data, breath_threshold)
+        if immediate:
+            gateway.flush()
+
+@metrics.timed()
+def cleanup_closed_trailing_files(exchange, symbols, snapshot=None):
+    # Stop-loss ticks keep running while we clean up; state they write after
+    # this point belongs to positions our view may be too old to know about
+    started = time.monotonic()
+    trailing_store = current().trailing_store
     try:
-        positionst = exchange.fetch_positions(symbols=symbols)
+        positionst = snapshot.positions if snapshot is not None else exchange.fetch_positions(symbols=symbols)
     except Exception as e:
-        print("❌ Failed to fetch positions for cleanup:", e)
+        log.error("❌ Failed to fetch positions for cleanup: %s", e)
         return
 
     active = {
-        ('buy' if pos.get('side', '').lower() == 'long' else 'sell', f"{safe_filename(pos.get('symbol'))}.json")
+        (pos.get('symbol'), pos.get('side', '').lower())
         for pos in positionst
         if pos.get('contracts', 0) > 0 and pos.get('side', '').lower() in ['long', 'short']
     }
     
     deleted_symbols = set()
 
-    for subfolder in ['buy', 'sell']:
-        path = os.path.join(TRAILING_FOLDER, subfolder)
-        try:
-            for fname in os.listdir(path):
-                if (subfolder, fname) not in active:
-                    os.remove(os.path.join(path, fname))
-                    print(f"🧹 Deleted stale trailing file: {subfolder}/{fname}")
-                    
-                    # 🔑 Add symbol to list of deleted ones
-                    symbol_name = filename_to_symbol(fname)
-                    if symbol_name:
-                        deleted_symbols.add(symbol_name)
-        except FileNotFoundError:
-            continue
+    for symbol, side in trailing_store.keys():
+        if (symbol, side) not in active and not trailing_store.touched_since(symbol, side, started):
+            trailing_store.delete(symbol, side)
+            current().triggers.disarm(symbol, side)
+            decision(log, 'delete_state', symbol, side, f"🧹 Deleted stale trailing state: {symbol} ({side})")
+
+            # 🔑 Add symbol to list of deleted ones
+            deleted_symbols.add(symbol)
+    trailing_store.flush()
         
-    # 🔁 Only cancel orphan orders for symbols whose trailing files were deleted
+    # 🔁 Only cancel orphan orders for symbols whose trailing state was deleted
     try:
         if deleted_symbols:
-            cancel_orphan_orders(exchange, list(deleted_symbols), 'limit')
+            cancel_orphan_orders(exchange, list(deleted_symbols), 'limit', snapshot)
     except Exception as e:
-        print(f"⚠️ Error while cancelling orphan orders during cleanup: {e}")
+        log.error("⚠️ Error while cancelling orphan orders during cleanup: %s", e)
 
 
 cancel_queue = queue.Queue()
 
-def create_exchange():
-    return ccxt.phemex({
-        'apiKey': api_key,
-        'secret': secret,
-        'enableRateLimit': True,
-    })
+def track_order(order_index, kind, op, result):
+    # Whatever the gateway did is reflected in the index without another fetch
+    if kind == 'cancel':
+        order_index.forget(op['id'])
+        return
+    if kind == 'move' and result.get('id') != op['id']:
+        order_index.forget(op['id'])
+    order_index.apply(dict(
+        result,
+        symbol=result.get('symbol') or op['symbol'],
+        side=result.get('side') or op['side'],
+        type=result.get('type') or op.get('type', 'stop'),
+    ))
+
+def contract_size(exchange, symbol):
+    info = get_market_cache(exchange).get(symbol)
+    return info.contract_size if info is not None else 1.0
+
+def order_events(kind, op, result):
+    # The gateway's results as feed order events, for a stream engine whose
+    # books would otherwise only learn of our orders when the feed echoes them
+    symbol = op['symbol']
+    if kind == 'cancel':
+        return [{'type': 'order', 'symbol': symbol, 'data': {'id': op['id'], 'symbol': symbol, 'status': 'canceled'}}]
+    events = []
+    if kind == 'move' and op['id'] and result.get('id') != op['id']:
+        events.append({'type': 'order', 'symbol': symbol, 'data': {'id': op['id'], 'symbol': symbol, 'status': 'canceled'}})
+    events.append({'type': 'order', 'symbol': symbol, 'data': dict(
+        result,
+        symbol=result.get('symbol') or symbol,
+        side=result.get('side') or op['side'],
+        type=result.get('type') or op.get('type', 'stop'),
+    )})
+    return events
+
+def new_order_gateway(exchange):
+    # Hedge / one-way modes, the orphan-order index, the journal and the
+    # stream engine's order books are the account's own
+    account = current()
+
+    def listener(kind, op, result):
+        track_order(account.order_index, kind, op, result)
+        account.journal.record_order(kind, op, result, contract_size(exchange, op['symbol']))
+        if account.stream_engine is not None:
+            for event in order_events(kind, op, result):
+                account.stream_engine.post(event)
+
+    return OrderGateway(exchange, resolver=account.position_modes, listener=listener)
+
+# One cache per exchange id, shared by every account on that exchange
+market_caches = {}
+market_caches_lock = threading.Lock()
+
+def get_market_cache(exchange):
+    with market_caches_lock:
+        cache = market_caches.get(exchange.id)
+        if cache is None:
+            cache = market_caches[exchange.id] = MarketCache(exchange, MARKETS_TTL)
+        else:
+            cache.attach(exchange)
+    return cache
+
+
+# Candles are market data too: one cache per exchange, shared by its accounts
+candle_caches = {}
+candle_caches_lock = threading.Lock()
+
+def get_candle_cache(exchange):
+    # NumPy is only loaded once something asks for candles
+    from candles import CandleCache
+
+    with candle_caches_lock:
+        cache = candle_caches.get(exchange.id)
+        if cache is None:
+            cache = candle_caches[exchange.id] = CandleCache(CANDLE_TIMEFRAME, CANDLE_HISTORY, CANDLE_WINDOW)
+        return cache
+
+def feed_marks(exchange, marks):
+    # Keeps symbols someone asked candles for current; without a cache nobody did
+    cache = candle_caches.get(exchange.id)
+    if cache is not None:
+        for symbol, price in marks:
+            cache.on_mark(symbol, price)
+
+def create_exchange(credentials=None, exchange_id='phemex', options=None):
+    config = {'enableRateLimit': True, **(credentials or {'apiKey': api_key, 'secret': secret})}
+    if options:
+        config['options'] = options
+    exchange = getattr(ccxt, exchange_id)(config)
+    return schedule_requests(InstrumentedExchange(exchange, metrics))
+
+def schedule_requests(exchange):
+    # Every request, from any thread, goes through the same budget (one per
+    # account), stop placement and cancels first
+    scheduler = RequestScheduler(exchange.rateLimit, RATE_BURST, on_wait=metrics.record_wait)
+    return ScheduledExchange(exchange, scheduler, REQUEST_RETRIES, REQUEST_BACKOFF)
 
 def cancel_thread_func(exchange, pos, symbol, order_type):
     try:
         cancel_orphan_orders(exchange, pos, symbol, order_type)
     except Exception as e:
-        print(f"Error in cancel_orphan_orders for {symbol}: {e}")
-        traceback.print_exc()
+        log.exception("Error in cancel_orphan_orders for %s: %s", symbol, e)
 
 def monitor_thread_func(exchange, symbol, pos):
     try:
         monitor_position_and_reenter(exchange, symbol, pos)
     except Exception as e:
-        print(f"Error in monitor_position_and_reenter for {symbol}: {e}")
-        traceback.print_exc()
+        log.exception("Error in monitor_position_and_reenter for %s: %s", symbol, e)
+
+def process_position(exchange, pos, snapshot=None, gateway=None, exposure=None):
+    # Both steps for a symbol run back to back in the same worker so the
+    # stop-loss is always decided before we look at re-entry
+    symbol = pos['symbol']
+    if trailing_stop_logic(exchange, pos, TRAIL_STEP, TRAIL_STEP, gateway):
+        # Its local stop closed it; a re-entry now would reopen it unprotected
+        return
 
+    if pos.get('contracts', 0) > 0:
+        monitor_position_and_reenter(exchange, symbol, pos, snapshot, gateway, exposure)
+
+
+position_pool = None
+
+def get_position_pool():
+    global position_pool
+    if position_pool is None:
+        position_pool = ThreadPoolExecutor(max_workers=POSITION_WORKERS, thread_name_prefix="position")
+    return position_pool
+
+def has_same_side_limit(exchange, position, snapshot):
+    open_orders = snapshot.open_orders(position['symbol'])
+    if open_orders is None:
+        open_orders = exchange.fetch_open_orders(position['symbol'])
+    side_str = 'buy' if (position.get('side') or '').lower() == 'long' else 'sell'
+    return any(o['type'] == 'limit' and o['side'] == side_str for o in open_orders)
+
+def process_positions_vectorized(exchange, snapshot, gateway, breath_threshold=TRAIL_STEP, exposure=None):
+    # Only this mode needs NumPy, so only it pays for importing it
+    from risk import evaluate_risk
+
+    markets = get_market_cache(exchange)
+    store = current().trailing_store
+    positions = snapshot.open_positions()
+    if STOP_MODE == 'local':
+        # Positions just closed at their local stop have nothing left to decide
+        positions = [p for p in positions if not local_stop_hit(exchange, p)]
+    infos = [markets.get(p['symbol']) for p in positions]
+    trail = None
+    if TRAIL_MODE != 'step':
+        trail = {
+            'mode': TRAIL_MODE,
+            'distance': TRAIL_DISTANCE,
+            'min_ticks': TRAIL_MIN_TICKS,
+            'stop_key': stop_key(),
+            'tick_size': [info.tick_size if info and info.tick_size else 0.0 for info in infos],
+            'atr': [symbol_atr(exchange, p['symbol']) or float('nan') for p in positions] if TRAIL_MODE == 'atr' else None,
+        }
+    actions = evaluate_risk(
+        positions,
+        {key: store.get(*key) for key in store.keys()},
+        DEFAULT_TRAILING,
+        [has_same_side_limit(exchange, p, snapshot) for p in positions],
+        [info is not None for info in infos],
+        REENTRY_FRACTION,
+        REENTRY_NOTIONAL_MULTIPLIER,
+        trail,
+    )
+    market_infos = {p['symbol']: info for p, info in zip(positions, infos)}
+    marks = {p['symbol']: float(p.get('markPrice') or 0) for p in positions}
+
+    for action in actions:
+        if action.kind == 'high_water':
+            trailing_data = load_trailing_data(action.symbol, action.side) or dict(DEFAULT_TRAILING)
+            trailing_data['hwm'] = action.price
+            save_trailing_data(action.symbol, trailing_data, action.side)
+        elif action.kind == 'drop_state':
+            trailing_data = load_trailing_data(action.symbol, action.side) or {}
+            drop_trailing_stop(gateway, action.symbol, action.side, trailing_data.get('orderId'))
+        elif action.kind == 'move_stop':
+            trailing_data = load_trailing_data(action.symbol, action.side) or dict(DEFAULT_TRAILING)
+            decision(log, 'move_stop', action.symbol, action.side, f"🔄 Moving stop-loss on {action.symbol} to {action.price:.4f}",
+                     stop=action.price, contracts=action.amount)
+            move_trailing_stop(gateway, action.symbol, action.side, action.amount, action.price, trailing_data,
+                               breath_threshold if trail is None else 0)
+        elif action.kind == 'reenter':
+            info = market_infos[action.symbol]
+            price, amount = action.price, action.amount
+            if REENTRY_MODE == 'volatility':
+                price, amount = volatility_reentry(exchange, action.symbol, action.side, marks[action.symbol], price, amount)
+            price = round_to_sig_figs(price, info.price_sig_digits)
+            amount = round_to_sig_figs(amount, info.amount_sig_digits)
+            order_side = 'sell' if action.side == 'short' else 'buy'
+            reEnterTrade(exchange, action.symbol, order_side, price, amount, 'limit', snapshot, gateway, exposure)
+
+def process_positions(exchange, snapshot, deadline, exposure_snapshot=None):
+    # exposure_snapshot: the whole account's positions and orders, when
+    # snapshot only carries the ones to process (stream mode)
+    account = current()
+    deferred_symbols = account.deferred_symbols
+    # Positions cut off by the budget last tick go first this time
+    positions = sorted(snapshot.positions, key=lambda p: p['symbol'] not in deferred_symbols)
+    # Orders decided by any position go out together once all have been looked at
+    gateway = new_order_gateway(exchange)
+    account.position_modes.learn_positions(positions)
+    account.order_index.load_all(snapshot.orders)
+    feed_marks(exchange, [(pos['symbol'], float(pos.get('markPrice') or 0)) for pos in positions])
+    # Fills that happened on the exchange since last tick (stops, re-entries) land in the ledger
+    # A tick's own snapshot holds every position; stream batches only the changed ones
+    account.journal.observe_positions(
+        positions, {pos['symbol']: contract_size(exchange, pos['symbol']) for pos in positions}, snapshot.taken_at,
+        complete=exposure_snapshot is None,
+    )
+    # Re-entries decided anywhere in the tick draw on the same margin
+    exposure = new_exposure_model(exchange, exposure_snapshot or snapshot)
+    skipped = []
+
+    if RISK_MODE == 'vector':
+        process_positions_vectorized(exchange, snapshot, gateway, exposure=exposure)
+    elif POSITION_WORKERS > 0:
+        # Workers are shared by every account; each task runs as the account that submitted it
+        futures = {
+            get_position_pool().submit(contextvars.copy_context().run, process_position, exchange, pos, snapshot, gateway, exposure): pos
+            for pos in positions
+        }
+        done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        for future in not_done:
+            # Queued work is dropped; work already talking to the exchange is let finish
+            if future.cancel():
+                skipped.append(futures[future]['symbol'])
+        wait([f for f in not_done if not f.cancelled()])
+        for future in futures:
+            if not future.cancelled() and future.exception():
+                log.error("Error processing %s", futures[future]['symbol'], exc_info=future.exception())
+    else:
+        for pos in positions:
+            if time.monotonic() >= deadline:
+                skipped.append(pos['symbol'])
+                continue
+            try:
+                process_position(exchange, pos, snapshot, gateway, exposure)
+            except Exception as e:
+                log.exception("Error processing %s: %s", pos['symbol'], e)
+
+    with metrics.stage('order_flush'):
+        gateway.flush()
+
+    # One write for everything this tick changed
+    with metrics.stage('state_flush'):
+        account.trailing_store.flush()
+        account.journal.flush()
+
+    deferred_symbols.clear()
+    deferred_symbols.update(skipped)
+    if skipped:
+        log.warning("⏱️ Tick budget of %ss used up, deferred %d positions to next tick", TICK_BUDGET, len(skipped))
+
+@metrics.timed()
 def main_job():
     try:
-        # Use the global exchange instance
-        global exchange
+        exchange = current().exchange
 
-        markets = exchange.load_markets()
-        all_symbols = [symbol for symbol in markets if ":USDT" in symbol]
-        positionst = exchange.fetch_positions(symbols=all_symbols)
-        usdt_balance_free = exchange.fetch_balance({'type': 'swap'})['USDT']['free']
-        print("USDT Balance (Free): ", usdt_balance_free)
+        deadline = time.monotonic() + TICK_BUDGET
+        all_symbols = get_market_cache(exchange).symbols()
+        # One read of positions, balance and open orders shared by the whole tick
+        snapshot = take_snapshot(exchange, all_symbols)
+        log.info("USDT Balance (Free): %s (Total): %s", snapshot.free('USDT'), snapshot.total('USDT'))
 
-        usdt_balance_total = exchange.fetch_balance({'type': 'swap'})['USDT']['total']
-        print("USDT Balance (Total): ", usdt_balance_total)
-        
-        for pos in positionst:
-            symbol = pos['symbol']
-            trailing_stop_logic(exchange, pos, 0.10, 0.10)
+        process_positions(exchange, snapshot, deadline)
 
-            if pos.get('contracts', 0) > 0:
-                monitor_position_and_reenter(exchange, symbol, pos)         
-                
         # # Run cancel_orphan_orders in its own thread immediately
         # cancel_orphan_orders(exchange, all_symbols, 'limit')
 
-        cleanup_closed_trailing_files(exchange, all_symbols)
-
     except Exception as e:
-        print("Error inside main_job:")
-        traceback.print_exc()
-
-if __name__ == "__main__":
-    exchange = create_exchange()
+        log.exception("Error inside main_job:")
+
+def create_feed_transport(symbols):
+    if FEED_REPLAY:
+        return ReplayTransport(FEED_REPLAY, float(os.getenv('FEED_REPLAY_SPEED', '0')))
+    if FEED_ADDRESS:
+        host, port = FEED_ADDRESS.rsplit(':', 1)
+        return SocketTransport(host, port)
+    return CcxtProTransport({**current().credentials, 'enableRateLimit': True}, symbols)
+
+def create_stream_engine(exchange):
+    all_symbols = get_market_cache(exchange).symbols()
+
+    def on_change(positions, orders):
+        for symbol, known in orders.items():
+            if known is None:
+                # First time we see this symbol: take its order book once over REST
+                known = exchange.fetch_open_orders(symbol)
+                engine.load_orders(symbol, known)
+                orders[symbol] = known
+        # Limits on total and per-symbol notional count everything held, not just what changed
+        everything = AccountSnapshot(
+            [pos for symbol in list(engine.positions) for pos in engine.symbol_positions(symbol)],
+            orders={symbol: engine.open_orders(symbol) for symbol in list(engine.orders)},
+        )
+        # Marks are fresh but sizes are only as new as the last position event;
+        # the journal mustn't read fills it already has off older sizes
+        taken_at = min((engine.seen.get(pos['symbol'], 0.0) for pos in positions), default=None)
+        process_positions(
+            exchange, AccountSnapshot(positions, orders=orders, taken_at=taken_at), time.monotonic() + TICK_BUDGET,
+            everything,
+        )
 
-    # Schedule main_job every 10 seconds
-    schedule.every(10).seconds.do(main_job)
+    def on_mark(symbol, price):
+        feed_marks(exchange, [(symbol, price)])
+        if STOP_MODE == 'local':
+            # Closed sides leave the engine now, not on the next position refresh,
+            # so on_change can't trail or re-enter what's already gone
+            for side in fire_local_stops(exchange, symbol, price):
+                engine.apply({'type': 'position', 'symbol': symbol,
+                              'data': {'side': side, 'contracts': 0, 'info': {'posSide': side.capitalize()}}})
+
+    def on_order(order):
+        # Fills are journaled as the feed reports them; the tick's flush writes them
+        current().journal.record_order_update(order, contract_size(exchange, order['symbol']))
+
+    engine = current().stream_engine = StreamEngine(
+        create_feed_transport(all_symbols), on_change, on_mark=on_mark, on_order=on_order,
+    )
+    if not FEED_REPLAY and not FEED_ADDRESS:
+        # Start from the REST view; the feed only carries changes from here on
+        positions = [p for p in exchange.fetch_positions(symbols=all_symbols) if float(p.get('contracts') or 0) > 0]
+        symbols = {p['symbol'] for p in positions}
+        engine.seed(positions, [o for symbol in symbols for o in exchange.fetch_open_orders(symbol)], symbols)
+    return engine
+
+def cleanup_job():
+    # Runs on its own, slower cadence next to the stop-loss ticks; its reads
+    # wait behind the ticks' when requests run short
+    try:
+        with housekeeping():
+            exchange = current().exchange
+            all_symbols = get_market_cache(exchange).symbols()
+            # Positions only; orders are fetched just for the symbols that need cleaning
+            snapshot = AccountSnapshot(exchange.fetch_positions(symbols=all_symbols))
+            cleanup_closed_trailing_files(exchange, all_symbols, snapshot)
+    except Exception:
+        log.exception("Error inside cleanup_job:")
+
+def warm_start(exchange):
+    # Starts the exchange on the markets the last run saved, so the first tick
+    # needn't wait on load_markets. True if it did and they want validating.
+    cache = get_market_cache(exchange)
+    if not MARKETS_SNAPSHOT or cache.snapshot_path is not None:
+        return False
+    cache.snapshot_path = MARKETS_SNAPSHOT.format(exchange=exchange.id)
+    return cache.load_snapshot(MARKETS_SNAPSHOT_MAX_AGE)
+
+def validate_warm_start(warm):
+    # Runs next to the first ticks: reload the markets a snapshot stood in
+    # for, then drop trailing state of positions closed while we were down
+    exchange = current().exchange
+    if warm:
+        with housekeeping():
+            get_market_cache(exchange).validate()
+    cleanup_job()
+
+def open_accounts():
+    if not ACCOUNTS_FILE:
+        account = current()
+        account.exchange = create_exchange()
+        return [account]
+    opened = []
+    for config in load_account_configs(ACCOUNTS_FILE):
+        exchange = create_exchange(config['credentials'], config['exchange'], config['options'])
+        opened.append(new_account(
+            config['name'], exchange, config['trailing_db'], config['credentials'], config['exchange'], config['journal_db'],
+        ))
+    return opened
 
-    print("Starting scheduler...")
-    while True:
-        try:
-            schedule.run_pending()
-            time.sleep(1)
-        except Exception as e:
-            print("Scheduler crashed:")
-            traceback.print_exc()
-            print("Retrying in 10 seconds...")
-            time.sleep(10)
+if __name__ == "__main__":
+    setup_logging(
+        LOG_LEVEL, LOG_FORMAT,
+        text_format='[%(account)s] %(message)s' if ACCOUNTS_FILE else '%(message)s',
+        filters=[AccountFilter()],
+    )
+    scheduler = TickScheduler()
+
+    # Every account gets its own jobs (and so its own threads), run as that account
+    for account in open_accounts():
+        prefix = f"{account.name}:" if ACCOUNTS_FILE else ''
+        warm = warm_start(account.exchange)
+        threading.Thread(target=run_as, args=(account, validate_warm_start, warm), name=f"{prefix}warm_start", daemon=True).start()
+        if FEED_MODE == 'stream':
+            # Positions are handled as the feed moves; only housekeeping is scheduled
+            engine = run_as(account, create_stream_engine, account.exchange)
+            threading.Thread(target=run_as, args=(account, engine.run), name=f"{prefix}stream", daemon=True).start()
+        else:
+            scheduler.every(TICK_INTERVAL, functools.partial(run_as, account, main_job), name=f"{prefix}main_job")
+        scheduler.every(CLEANUP_INTERVAL, functools.partial(run_as, account, cleanup_job), name=f"{prefix}cleanup_job", run_now=False)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    if METRICS_FILE:
+        scheduler.every(METRICS_INTERVAL, lambda: metrics.dump_json(METRICS_FILE), name="metrics_dump", run_now=False)
+
+    log.info("Starting scheduler...")
+    scheduler.run_forever()
@@ -0,0 +1,183 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+
+# Everything the hot path needs about a market, worked out once per refresh
+MarketInfo = namedtuple('MarketInfo', [
+    'symbol',
+    'tick_size',
+    'lot_size',
+    'price_sig_digits',
+    'amount_sig_digits',
+    'contract_type',
+    'contract_size',
+])
+
+
+def count_sig_digits(precision):
+    # Count digits after decimal point if it's a fraction
+    if precision < 1:
+        return abs(int(round(math.log10(precision))))
+    else:
+        return 1  # Treat whole numbers like 1, 10, 100 as 1 sig digit
+
+
+def market_info(market):
+    precision = market.get('precision') or {}
+    tick_size = precision.get('price')
+    lot_size = precision.get('amount')
+    return MarketInfo(
+        symbol=market['symbol'],
+        tick_size=tick_size,
+        lot_size=lot_size,
+        price_sig_digits=count_sig_digits(tick_size) if tick_size else None,
+        amount_sig_digits=count_sig_digits(lot_size) if lot_size else None,
+        contract_type=market.get('type'),
+        contract_size=float(market.get('contractSize') or 1),
+    )
+
+
+class MarketCache:
+    # Loads markets once and reloads them when they're older than ttl seconds,
+    # or when someone asks for a symbol we don't know (at most once per
+    # miss_cooldown, so a delisted symbol can't make us reload every tick).
+    #
+    # With a snapshot_path every load is also saved to disk, and
+    # load_snapshot() starts from the last saved markets instead of waiting
+    # on load_markets; validate() then reloads them in the background.
+    def __init__(self, exchange, ttl=3600, miss_cooldown=60, snapshot_path=None):
+        self.exchange = exchange
+        self.ttl = ttl
+        self.miss_cooldown = miss_cooldown
+        self.lock = threading.RLock()
+        # Held across load_markets, so one reload runs at a time without blocking lookups
+        self.refresh_lock = threading.RLock()
+        self.index = {}
+        self.usdt_symbols = []
+        self.loaded_at = None
+        self.last_miss_refresh = 0.0
+        self.markets = None
+        self.followers = []
+        self.snapshot_path = snapshot_path
+
+    def attach(self, exchange):
+        # Another connection to the same exchange (another account) gets the
+        # markets loaded here instead of loading its own. Every lookup comes
+        # through here, so a known connection returns without the lock.
+        if exchange is self.exchange or any(f is exchange for f in self.followers):
+            return
+        with self.lock:
+            if exchange is self.exchange or any(f is exchange for f in self.followers):
+                return
+            self.followers.append(exchange)
+            if self.markets is not None:
+                self._share(exchange)
+
+    def _share(self, exchange, currencies=None):
+        if hasattr(exchange, 'set_markets'):
+            exchange.set_markets(self.markets, currencies or getattr(self.exchange, 'currencies', None))
+
+    def _install(self, markets):
+        self.markets = markets
+        self.index = {symbol: market_info(market) for symbol, market in markets.items()}
+        self.usdt_symbols = [symbol for symbol in markets if ":USDT" in symbol]
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        with self.refresh_lock:
+            markets = self.exchange.load_markets(reload=self.loaded_at is not None)
+            with self.lock:
+                self._install(markets)
+                for follower in self.followers:
+                    self._share(follower)
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self.lock:
+            snapshot = {
+                'exchange': self.exchange.id,
+                'saved_at': time.time(),
+                'markets': self.markets,
+                'currencies': getattr(self.exchange, 'currencies', None),
+            }
+        tmp = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f, default=str)
+            os.replace(tmp, self.snapshot_path)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("⚠️ Failed to save markets to %s: %s", self.snapshot_path, e)
+
+    def load_snapshot(self, max_age):
+        # True if the markets saved by an earlier run are now in use
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("⚠️ Ignoring unreadable markets snapshot %s: %s", self.snapshot_path, e)
+            return False
+        age = time.time() - snapshot.get('saved_at', 0)
+        if snapshot.get('exchange') != self.exchange.id or age > max_age or not snapshot.get('markets'):
+            return False
+        with self.lock:
+            self._install(snapshot['markets'])
+            self._share(self.exchange, snapshot.get('currencies'))
+            for follower in self.followers:
+                self._share(follower)
+        log.info("♻️ Starting on %d saved markets from %s (%.0fs old)", len(self.markets), self.snapshot_path, age)
+        return True
+
+    def validate(self):
+        # Reloads markets we started on from a snapshot and says what changed meanwhile
+        before = set(self.index)
+        try:
+            self.refresh()
+        except Exception as e:
+            log.warning("⚠️ Could not check the saved markets against the exchange, keeping them: %s", e)
+            return False
+        added, removed = set(self.index) - before, before - set(self.index)
+        if added or removed:
+            log.info("🔎 Saved markets were behind: %d listed, %d delisted since", len(added), len(removed))
+        return True
+
+    def _stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl
+
+    def ensure_fresh(self):
+        if not self._stale():
+            return
+        # Several accounts may notice at once; only the first reloads. The
+        # rest go on with the markets we have, or wait if there are none yet.
+        if not self.refresh_lock.acquire(blocking=self.markets is None):
+            return
+        try:
+            if self._stale():
+                self.refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def symbols(self):
+        self.ensure_fresh()
+        return self.usdt_symbols
+
+    def get(self, symbol):
+        self.ensure_fresh()
+        info = self.index.get(symbol)
+        if info is None and time.monotonic() - self.last_miss_refresh >= self.miss_cooldown:
+            self.last_miss_refresh = time.monotonic()
+            log.info("🔎 Unknown market %s, reloading markets", symbol)
+            self.refresh()
+            info = self.index.get(symbol)
+        return info
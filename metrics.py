@@ -0,0 +1,232 @@
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# Seconds; wide enough for a 10s tick and narrow enough for a single REST call
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+API_PREFIXES = ('fetch', 'create', 'cancel', 'edit', 'load_markets', 'watch')
+
+
+def snake_case(name):
+    # fetchOpenOrders and fetch_open_orders are the same endpoint
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else 0.0,
+            'buckets': {str(bound): total for bound, total in self.cumulative()},
+        }
+
+
+class Metrics:
+    # Per-endpoint call counts, latencies and errors, per-stage timings and
+    # rate-limit waits. Exposed as Prometheus text or a JSON document.
+    def __init__(self, prefix='cryptsel'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+        self.stages = {}
+        self.stage_errors = {}
+        self.waits = Histogram()
+
+    def record_call(self, endpoint, seconds, error=None):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.latency.setdefault(endpoint, Histogram()).observe(seconds)
+            if error is not None:
+                key = (endpoint, type(error).__name__)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def record_stage(self, stage, seconds, error=None):
+        with self.lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+            if error is not None:
+                self.stage_errors[stage] = self.stage_errors.get(stage, 0) + 1
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.waits.observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record_stage(name, time.perf_counter() - started, error)
+
+    def timed(self, name=None):
+        def decorate(fn):
+            stage = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'uptime': round(time.time() - self.started, 1),
+                'api': {
+                    endpoint: dict(
+                        self.latency[endpoint].to_dict(),
+                        calls=count,
+                        errors={e: n for (ep, e), n in self.errors.items() if ep == endpoint},
+                    )
+                    for endpoint, count in sorted(self.calls.items())
+                },
+                'stages': {
+                    stage: dict(h.to_dict(), errors=self.stage_errors.get(stage, 0))
+                    for stage, h in sorted(self.stages.items())
+                },
+                'rate_limit_wait': self.waits.to_dict(),
+            }
+
+    def to_prometheus(self):
+        p = self.prefix
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, h in series:
+                sep = ',' if labels else ''
+                for bound, total in h.cumulative():
+                    lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}')
+                lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {h.count}')
+                braces = f"{{{labels}}}" if labels else ''
+                lines.append(f"{name}_sum{braces} {h.sum}")
+                lines.append(f"{name}_count{braces} {h.count}")
+
+        with self.lock:
+            lines.append(f"# HELP {p}_api_calls_total Exchange API calls by endpoint")
+            lines.append(f"# TYPE {p}_api_calls_total counter")
+            for endpoint, count in sorted(self.calls.items()):
+                lines.append(f'{p}_api_calls_total{{endpoint="{endpoint}"}} {count}')
+            lines.append(f"# HELP {p}_api_errors_total Failed exchange API calls by endpoint and error")
+            lines.append(f"# TYPE {p}_api_errors_total counter")
+            for (endpoint, error), count in sorted(self.errors.items()):
+                lines.append(f'{p}_api_errors_total{{endpoint="{endpoint}",error="{error}"}} {count}')
+            histogram(f"{p}_api_latency_seconds", "Exchange API call latency",
+                      [(f'endpoint="{e}"', h) for e, h in sorted(self.latency.items())])
+            histogram(f"{p}_stage_seconds", "Time spent in each stage of the bot",
+                      [(f'stage="{s}"', h) for s, h in sorted(self.stages.items())])
+            lines.append(f"# HELP {p}_stage_errors_total Stages that ended in an exception")
+            lines.append(f"# TYPE {p}_stage_errors_total counter")
+            for stage, count in sorted(self.stage_errors.items()):
+                lines.append(f'{p}_stage_errors_total{{stage="{stage}"}} {count}')
+            histogram(f"{p}_rate_limit_wait_seconds", "Time requests waited for the rate budget", [('', self.waits)])
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        # Write then rename so readers never see half a file
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(tmp, path)
+
+    def serve(self, port, host='0.0.0.0'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body, content_type = json.dumps(metrics.to_dict()).encode(), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes every few seconds would drown the bot's own output
+
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        log.info("📊 Serving metrics on http://%s:%s/metrics", host, port)
+        return server
+
+
+class InstrumentedExchange:
+    # Stands in for the ccxt exchange and times every API method called on it.
+    # Everything else (markets, has, attributes being set) goes straight through.
+    def __init__(self, exchange, metrics):
+        object.__setattr__(self, '_exchange', exchange)
+        object.__setattr__(self, '_metrics', metrics)
+        object.__setattr__(self, '_wrapped', {})
+
+    def __getattr__(self, name):
+        attr = getattr(self._exchange, name)
+        if not callable(attr) or not name.startswith(API_PREFIXES):
+            return attr
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            endpoint = snake_case(name)
+            metrics = self._metrics
+            exchange = self._exchange
+
+            @functools.wraps(attr)
+            def wrapped(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    result = getattr(exchange, name)(*args, **kwargs)
+                except Exception as e:
+                    metrics.record_call(endpoint, time.perf_counter() - started, e)
+                    raise
+                metrics.record_call(endpoint, time.perf_counter() - started)
+                return result
+
+            self._wrapped[name] = wrapped
+        return wrapped
+
+    def __setattr__(self, name, value):
+        setattr(self._exchange, name, value)
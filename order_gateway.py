@@ -0,0 +1,164 @@
+import contextvars
+import logging
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class OrderGateway:
+    # Collects the cancels, creates and stop moves decided during a tick and
+    # sends them together in flush(). Every call returns a Future that gets the
+    # exchange's order (or the error) once the batch has gone out.
+    #
+    # Ops given a pos_side ('long' / 'short') get their posSide from the
+    # resolver and are retried once if the exchange rejects the position mode.
+    # listener(kind, op, result) hears about every op that went through.
+    def __init__(self, exchange, resolver=None, max_parallel=8, listener=None):
+        self.exchange = exchange
+        self.resolver = resolver
+        self.max_parallel = max_parallel
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def _submit(self, kind, op):
+        future = Future()
+        if self.listener is not None:
+            future.add_done_callback(lambda f: self._notify(kind, op, f))
+        with self.lock:
+            self.pending.append((kind, op, future))
+        return future
+
+    def cancel(self, order_id, symbol, params=None, pos_side=None):
+        return self._submit('cancel', {
+            'id': order_id,
+            'symbol': symbol,
+            'params': params or {},
+            'pos_side': pos_side,
+        })
+
+    def create(self, symbol, type, side, amount, price=None, params=None, pos_side=None):
+        return self._submit('create', {
+            'symbol': symbol,
+            'type': type,
+            'side': side,
+            'amount': amount,
+            'price': price,
+            'params': params or {},
+            'pos_side': pos_side,
+        })
+
+    def move_stop(self, order_id, symbol, side, amount, stop_price, params, pos_side=None):
+        # Amends the resting stop in place where the exchange supports it,
+        # otherwise (or if the amend fails) cancels it and places a new one
+        return self._submit('move', {
+            'id': order_id,
+            'symbol': symbol,
+            'side': side,
+            'amount': amount,
+            'stop_price': stop_price,
+            'params': dict(params, stopPx=stop_price),
+            'pos_side': pos_side,
+        })
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        cancels = [(op, future) for kind, op, future in pending if kind == 'cancel']
+        others = [(kind, op, future) for kind, op, future in pending if kind != 'cancel']
+
+        # Cancels go first so replaced orders are off the book before new ones land
+        self._run_cancels(cancels)
+        self._run_parallel([(self._move if kind == 'move' else self._create, op, future) for kind, op, future in others])
+        return len(pending)
+
+    def _notify(self, kind, op, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            self.listener(kind, op, future.result())
+        except Exception as e:
+            log.warning("⚠️ Order listener failed on %s %s: %s", kind, op['symbol'], e)
+
+    def _params(self, op, mode=None):
+        if self.resolver is None or op['pos_side'] is None:
+            return op['params']
+        return dict(op['params'], **self.resolver.params(op['symbol'], op['pos_side'], mode))
+
+    def _with_mode(self, call, op):
+        # The mode is read once, so a rejection flips away from the one this call used
+        mode = self.resolver.mode(op['symbol']) if self.resolver is not None else None
+        try:
+            return call(self._params(op, mode))
+        except Exception as e:
+            if self.resolver is None or op['pos_side'] is None or not self.resolver.on_error(op['symbol'], e, mode):
+                raise
+            return call(self._params(op))
+
+    def _cancel(self, op):
+        return self._with_mode(lambda params: self.exchange.cancel_order(op['id'], op['symbol'], params), op)
+
+    def _create(self, op):
+        return self._with_mode(lambda params: self.exchange.create_order(
+            op['symbol'], op['type'], op['side'], op['amount'], op['price'], params
+        ), op)
+
+    def _move(self, op):
+        if op['id'] and self.exchange.has.get('editOrder'):
+            try:
+                return self._with_mode(lambda params: self.exchange.edit_order(
+                    op['id'], op['symbol'], 'stop', op['side'], op['amount'], None,
+                    {k: v for k, v in params.items() if k in ('stopPx', 'posSide')},
+                ), op)
+            except Exception as e:
+                log.warning("⚠️ Amending stop %s on %s failed: %s — replacing it", op['id'], op['symbol'], e)
+        if op['id']:
+            try:
+                self._cancel(op)
+            except Exception as e:
+                log.warning("⚠️ Failed to cancel stop-loss %s: %s", op['id'], e)
+        return self._create(dict(op, type='stop', price=None))
+
+    def _run_cancels(self, cancels):
+        if not cancels:
+            return
+        if not self.exchange.has.get('cancelOrders'):
+            self._run_parallel([(self._cancel, op, future) for op, future in cancels])
+            return
+
+        # One bulk call per symbol and param set; anything the bulk call can't
+        # take goes one by one so the mode retry still applies per order
+        groups = {}
+        for op, future in cancels:
+            key = (op['symbol'], tuple(sorted(self._params(op).items())))
+            groups.setdefault(key, []).append((op, future))
+        singles = []
+        for (symbol, params), items in groups.items():
+            try:
+                results = self.exchange.cancel_orders([op['id'] for op, _ in items], symbol, dict(params))
+            except Exception:
+                singles.extend(items)
+                continue
+            for i, (op, future) in enumerate(items):
+                future.set_result(results[i] if results and i < len(results) else {'id': op['id']})
+        self._run_parallel([(self._cancel, op, future) for op, future in singles])
+
+    def _run_parallel(self, calls):
+        def run(call, op, future):
+            try:
+                future.set_result(call(op))
+            except Exception as e:
+                future.set_exception(e)
+
+        if len(calls) <= 1 or self.max_parallel <= 1:
+            for call in calls:
+                run(*call)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(calls))) as pool:
+            for call in calls:
+                # Callbacks on the futures run in the pool; give them the flushing thread's context
+                pool.submit(contextvars.copy_context().run, run, *call)
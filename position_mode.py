@@ -0,0 +1,62 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+POS_MODE_ERROR = 'TE_ERR_INCONSISTENT_POS_MODE'
+
+HEDGE = 'hedge'
+ONE_WAY = 'oneway'
+
+
+class PositionModeResolver:
+    # Remembers whether each symbol trades in hedge or one-way mode so orders go
+    # out with the right posSide the first time. Modes are learned from the
+    # posSide Phemex reports on positions and orders, or from a rejected order,
+    # and flipped again whenever the exchange says we got it wrong.
+    def __init__(self, default=ONE_WAY):
+        self.default = default
+        self.modes = {}
+        self.lock = threading.Lock()
+
+    def mode(self, symbol):
+        with self.lock:
+            return self.modes.get(symbol, self.default)
+
+    def set_mode(self, symbol, mode):
+        with self.lock:
+            if self.modes.get(symbol) != mode:
+                self.modes[symbol] = mode
+                # Accounts usually run every symbol the same way; guess that for new ones
+                self.default = mode
+
+    def learn(self, symbol, info):
+        pos_side = (info or {}).get('posSide')
+        if pos_side == 'Merged':
+            self.set_mode(symbol, ONE_WAY)
+        elif pos_side in ('Long', 'Short'):
+            self.set_mode(symbol, HEDGE)
+
+    def learn_positions(self, positions):
+        for p in positions:
+            if float(p.get('contracts') or 0) > 0:
+                self.learn(p['symbol'], p.get('info'))
+
+    def params(self, symbol, pos_side, mode=None):
+        # pos_side is the position the order belongs to: 'long' or 'short'
+        if (mode or self.mode(symbol)) == HEDGE:
+            return {'posSide': 'Long' if pos_side == 'long' else 'Short'}
+        return {}
+
+    def on_error(self, symbol, error, used=None):
+        # True when the error was a mode mismatch and the order is worth
+        # retrying. used is the mode the failed order went out in; if another
+        # order on the symbol has flipped it meanwhile, it stays flipped.
+        if POS_MODE_ERROR not in str(error):
+            return False
+        with self.lock:
+            current = self.modes.get(symbol, self.default)
+            if used is None or current == used:
+                self.modes[symbol] = ONE_WAY if current == HEDGE else HEDGE
+        log.info("🔁 %s is in %s mode, retrying with matching params", symbol, self.mode(symbol))
+        return True
@@ -0,0 +1,177 @@
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+import ccxt
+
+from metrics import API_PREFIXES, snake_case
+
+log = logging.getLogger(__name__)
+
+# Lower goes first
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = ('high', 'normal', 'low')
+
+# Orders that protect a position: cancels, amends and anything that can only reduce it
+PROTECTIVE_PARAMS = ('stopPx', 'stopPrice', 'triggerPrice', 'stopLossPrice', 'reduceOnly', 'closeOnTrigger')
+HIGH_ENDPOINTS = ('cancel_order', 'cancel_orders', 'cancel_all_orders', 'edit_order')
+LOW_ENDPOINTS = ('fetch_balance', 'load_markets', 'fetch_markets', 'fetch_currencies', 'fetch_ohlcv', 'fetch_time')
+
+# Priority of the request about to go out, read by the throttle ccxt calls for it
+_priority = contextvars.ContextVar('request_priority', default=NORMAL)
+_housekeeping = contextvars.ContextVar('housekeeping', default=False)
+
+
+@contextmanager
+def housekeeping():
+    # Reads made in here (cleanup, market reloads) queue behind the trading
+    # loop's; orders keep their own priority
+    token = _housekeeping.set(True)
+    try:
+        yield
+    finally:
+        _housekeeping.reset(token)
+
+
+def request_priority(endpoint, args, kwargs):
+    if endpoint in HIGH_ENDPOINTS:
+        return HIGH
+    if endpoint == 'create_order':
+        params = kwargs.get('params', args[5] if len(args) > 5 else None) or {}
+        if any(params.get(key) for key in PROTECTIVE_PARAMS):
+            return HIGH
+        return NORMAL
+    if endpoint in LOW_ENDPOINTS or _housekeeping.get():
+        return LOW
+    return NORMAL
+
+
+class RequestScheduler:
+    # One token bucket per exchange connection, filling at the exchange's
+    # rateLimit and holding up to `burst` cost units. Every request ccxt makes
+    # pays its endpoint's weight (the cost ccxt hands to throttle) before it
+    # goes out. Waiting requests are served by priority, and normal / low
+    # ones may only spend down to their share of `reserve`, so close to the
+    # limit the last tokens always go to stop placement and cancels.
+    def __init__(self, rate_limit_ms, burst=10, reserve=(0.0, 0.3, 0.6), on_wait=None):
+        self.rate = 1000.0 / rate_limit_ms if rate_limit_ms else float('inf')
+        self.capacity = float(burst)
+        self.floors = [self.capacity * share for share in reserve]
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.on_wait = on_wait
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.seq = itertools.count()
+
+    def _refill(self, now):
+        if self.rate == float('inf'):
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost=1, priority=NORMAL):
+        started = time.monotonic()
+        ticket = (priority, next(self.seq))
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    need = min(self.floors[priority] + cost, self.capacity)
+                    if now >= self.paused_until and self.waiting[0] == ticket and self.tokens >= need:
+                        self.tokens -= cost
+                        break
+                    if now < self.paused_until:
+                        timeout = self.paused_until - now
+                    elif self.waiting[0] != ticket:
+                        # Someone ahead of us; they wake us when they're through
+                        timeout = None
+                    else:
+                        timeout = (need - self.tokens) / self.rate
+                    self.cond.wait(timeout)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+        if self.on_wait is not None:
+            self.on_wait(time.monotonic() - started)
+
+    def throttle(self, cost=None):
+        # Stands in for ccxt's throttle
+        self.acquire(1 if cost is None else cost, _priority.get())
+
+    def pause(self, seconds):
+        # The exchange pushed back: nobody sends anything for a while, then the bucket starts empty
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self.cond.notify_all()
+
+
+class ScheduledExchange:
+    # Stands in for the exchange and sends every API call through the
+    # scheduler at its priority. Calls failing on a 429 pause the whole
+    # bucket and are retried after a jittered exponential backoff, as are
+    # reads, cancels and amends failing on a network error. A create that
+    # timed out may have gone through, so only rate limits retry those.
+    def __init__(self, exchange, scheduler, retries=3, backoff=0.5, max_backoff=10.0):
+        object.__setattr__(self, '_exchange', exchange)
+        object.__setattr__(self, '_scheduler', scheduler)
+        object.__setattr__(self, '_retries', retries)
+        object.__setattr__(self, '_backoff', backoff)
+        object.__setattr__(self, '_max_backoff', max_backoff)
+        object.__setattr__(self, '_wrapped', {})
+        exchange.throttle = scheduler.throttle
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+    def __getattr__(self, name):
+        attr = getattr(self._exchange, name)
+        if not callable(attr) or not name.startswith(API_PREFIXES):
+            return attr
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            endpoint = snake_case(name)
+            exchange = self._exchange
+
+            @functools.wraps(attr)
+            def wrapped(*args, **kwargs):
+                priority = request_priority(endpoint, args, kwargs)
+                attempt = 0
+                while True:
+                    token = _priority.set(priority)
+                    try:
+                        return getattr(exchange, name)(*args, **kwargs)
+                    except (ccxt.RateLimitExceeded, ccxt.DDoSProtection) as e:
+                        error, delay = e, self._delay(attempt)
+                        self._scheduler.pause(delay)
+                    except ccxt.NetworkError as e:
+                        if endpoint == 'create_order':
+                            raise
+                        error, delay = e, self._delay(attempt)
+                    finally:
+                        _priority.reset(token)
+                    if attempt >= self._retries:
+                        raise error
+                    attempt += 1
+                    log.warning("⚠️ %s (%s priority) failed: %s — retry %d/%d in %.2fs",
+                                endpoint, PRIORITY_NAMES[priority], error, attempt, self._retries, delay)
+                    time.sleep(delay)
+
+            self._wrapped[name] = wrapped
+        return wrapped
+
+    def __setattr__(self, name, value):
+        setattr(self._exchange, name, value)
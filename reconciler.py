@@ -0,0 +1,125 @@
+import threading
+import time
+
+OPEN_STATUSES = (None, 'open', 'new', 'partially_filled')
+
+
+class OrderReconciler:
+    # Index of our open orders by id and by (symbol, side), kept up to date
+    # from whatever we learn anyway: a symbol's order book when a tick reads
+    # it, our own creates / cancels / amends as they complete, order events
+    # from the feed. A symbol is marked dirty when its orders or its position
+    # change, and reconcile() only looks at dirty symbols, so a pass over
+    # hundreds of quiet markets costs nothing.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.orders = {}
+        self.by_key = {}
+        self.loaded_at = {}
+        self.positions = {}
+        self.dirty = set()
+
+    def _add(self, order):
+        old = self.orders.get(order['id'])
+        if old is not None:
+            self._remove(old['id'])
+        self.orders[order['id']] = order
+        self.by_key.setdefault((order['symbol'], order['side'].lower()), set()).add(order['id'])
+
+    def _remove(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        key = (order['symbol'], order['side'].lower())
+        ids = self.by_key.get(key)
+        if ids is not None:
+            ids.discard(order_id)
+            if not ids:
+                del self.by_key[key]
+        return order
+
+    def load(self, symbol, orders):
+        # The full, current order book of one symbol
+        with self.lock:
+            current = {o['id'] for o in orders}
+            known = self.by_key.get((symbol, 'buy'), set()) | self.by_key.get((symbol, 'sell'), set())
+            for order_id in known - current:
+                self._remove(order_id)
+            for order in orders:
+                self._add(dict(order))
+            if current != known or symbol not in self.loaded_at:
+                self.dirty.add(symbol)
+            self.loaded_at[symbol] = time.monotonic()
+
+    def load_all(self, orders_by_symbol):
+        for symbol, orders in orders_by_symbol.items():
+            if orders is not None:
+                self.load(symbol, orders)
+
+    def apply(self, order):
+        # One order we placed, amended or heard about from the feed
+        if not order or not order.get('id') or not order.get('symbol') or not order.get('side'):
+            return
+        with self.lock:
+            if order.get('status') in OPEN_STATUSES:
+                self._add(dict(order))
+            else:
+                self._remove(order['id'])
+            self.dirty.add(order['symbol'])
+
+    def forget(self, order_id):
+        with self.lock:
+            order = self._remove(order_id)
+            if order is not None:
+                self.dirty.add(order['symbol'])
+
+    def touch(self, symbol):
+        # Look at this symbol again on the next pass, e.g. after a failed cancel
+        with self.lock:
+            self.dirty.add(symbol)
+
+    def stale(self, symbols, max_age, limit):
+        # Symbols whose book we've never read, plus the `limit` oldest reads past max_age
+        with self.lock:
+            now = time.monotonic()
+            unknown = [s for s in symbols if s not in self.loaded_at]
+            old = sorted(
+                (self.loaded_at[s], s) for s in symbols
+                if s in self.loaded_at and now - self.loaded_at[s] >= max_age
+            )
+            return unknown + [s for _, s in old[:limit]]
+
+    def set_positions(self, positions_map, symbols):
+        # positions_map in AccountSnapshot.positions_map() shape; symbols it
+        # doesn't mention have no position
+        with self.lock:
+            for symbol in symbols:
+                info = positions_map.get(symbol)
+                side = info['side'] if info and info['has_position'] else None
+                if self.positions.get(symbol) != side:
+                    self.positions[symbol] = side
+                    self.dirty.add(symbol)
+
+    def open_orders(self, symbol, side=None):
+        with self.lock:
+            sides = (side,) if side else ('buy', 'sell')
+            return [self.orders[i] for s in sides for i in self.by_key.get((symbol, s), ())]
+
+    def reconcile(self, order_type, symbols):
+        # (order, reason) for every order_type order on a dirty symbol that
+        # has no position ('orphan') or sits on the other side of it ('mismatched')
+        with self.lock:
+            due = self.dirty.intersection(symbols)
+            self.dirty.difference_update(due)
+            found = []
+            for symbol in sorted(due):
+                side = self.positions.get(symbol)
+                for order in self.open_orders(symbol):
+                    if order['type'] != order_type:
+                        continue
+                    order_side = order['side'].lower()
+                    if side is None:
+                        found.append((order, 'orphan'))
+                    elif (order_side == 'buy' and side != 'long') or (order_side == 'sell' and side != 'short'):
+                        found.append((order, 'mismatched'))
+            return found
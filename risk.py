@@ -0,0 +1,119 @@
+import numpy as np
+
+from collections import namedtuple
+
+from trailing import TRAIL_MODES
+
+# One thing the tick should do for one position:
+#   drop_state - the position gave back its profit, cancel the stop and forget it
+#   move_stop  - move the stop to price for amount contracts
+#   high_water - continuous trailing only: the position's high-water mark is now price
+#   reenter    - place a limit re-entry at price for amount (unrounded)
+Action = namedtuple('Action', ['kind', 'symbol', 'side', 'price', 'amount'])
+
+
+def _column(positions, key, default=0.0):
+    return np.fromiter((float(p.get(key) or default) for p in positions), dtype=float, count=len(positions))
+
+
+def _trail_stops(sign, is_long, mark, states, trail):
+    # trailing.ratchet for every position at once; NaN where there's no stop
+    n = len(mark)
+    previous = np.fromiter(
+        (np.nan if st is None or st.get('hwm') is None else st['hwm'] for st in states), dtype=float, count=n
+    )
+    current = np.fromiter(
+        (np.nan if st is None or st.get(trail['stop_key']) is None else st[trail['stop_key']] for st in states),
+        dtype=float, count=n,
+    )
+    tick = np.nan_to_num(np.asarray(trail['tick_size'], dtype=float))
+    hwm = np.where(is_long, np.fmax(previous, mark), np.fmin(previous, mark))
+    if trail['mode'] == 'percent':
+        gap = hwm * trail['distance']
+    elif trail['mode'] == 'atr':
+        gap = np.asarray(trail['atr'], dtype=float) * trail['distance']
+    elif trail['mode'] == 'fixed':
+        gap = np.full(n, float(trail['distance']))
+    else:
+        raise ValueError(f"Unknown trailing mode {trail['mode']!r}, expected one of {', '.join(TRAIL_MODES)}")
+    raw = hwm - sign * gap
+    has_tick = tick > 0
+    ticks = np.divide(raw, tick, out=np.zeros(n), where=has_tick)
+    on_grid = np.where(is_long, np.floor(ticks + 1e-9), np.ceil(ticks - 1e-9)) * tick
+    stop = np.where(has_tick, np.round(on_grid, 12), raw)
+    better = np.isnan(current) | (sign * (stop - current) >= trail['min_ticks'] * tick + 1e-12)
+    return previous, hwm, np.where(better, stop, np.nan)
+
+
+def evaluate_risk(positions, states, default_state, has_same_side_limit, market_known,
+                  reentry_fraction=0.2, reentry_multiplier=1.5, trail=None):
+    # Same decisions as trailing_stop_logic followed by monitor_position_and_reenter,
+    # worked out for every position at once.
+    #   states: (symbol, side) -> trailing state
+    #   has_same_side_limit / market_known: one bool per position
+    #   trail: continuous trailing settings (mode, distance, min_ticks,
+    #          stop_key, and per position tick_size and atr), None for steps
+    n = len(positions)
+    if n == 0:
+        return []
+
+    sides = [(p.get('side') or '').lower() for p in positions]
+    is_long = np.fromiter((s == 'long' for s in sides), dtype=bool, count=n)
+    is_short = np.fromiter((s == 'short' for s in sides), dtype=bool, count=n)
+    sign = np.where(is_long, 1.0, -1.0)
+
+    entry = _column(positions, 'entryPrice')
+    mark = _column(positions, 'markPrice')
+    liquidation = _column(positions, 'liquidationPrice')
+    contracts = _column(positions, 'contracts')
+    leverage = _column(positions, 'leverage', 1.0)
+    leverage[leverage == 0] = 1.0
+    notional = _column(positions, 'notional')
+    realized = np.fromiter(
+        (float((p.get('info') or {}).get('curTermRealisedPnlRv') or 0) for p in positions), dtype=float, count=n
+    )
+
+    keyed = [states.get((p['symbol'], s)) for p, s in zip(positions, sides)]
+    has_state = np.fromiter((st is not None for st in keyed), dtype=bool, count=n)
+    threshold = np.fromiter(((st or default_state)['threshold'] for st in keyed), dtype=float, count=n)
+    target = np.fromiter(((st or default_state)['profit_target_distance'] for st in keyed), dtype=float, count=n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Trailing stop
+        tradable = (entry != 0) & (mark != 0) & (is_long | is_short) & (contracts > 0)
+        profit_distance = sign * (mark - entry) / entry * leverage
+        total_pnl = sign * (mark - entry) * contracts + realized
+        drop = tradable & (total_pnl <= 0.001)
+        if trail is None:
+            new_stop = entry * (1 + sign * target / leverage)
+            move = tradable & ~drop & (profit_distance >= threshold) & (sign * (new_stop - entry) > 0)
+            high_water = np.zeros(n, dtype=bool)
+        else:
+            previous_hwm, hwm, new_stop = _trail_stops(sign, is_long, mark, keyed, trail)
+            high_water = tradable & ~drop & (hwm != previous_hwm)
+            move = (
+                tradable & ~drop & ~np.isnan(new_stop)
+                & (sign * (new_stop - entry) > 0) & (sign * (mark - new_stop) > 0)
+            )
+
+        # Re-entry
+        reenter = (
+            (contracts > 0) & (liquidation != 0) & (entry != 0) & (mark != 0)
+            & np.asarray(market_known, dtype=bool) & ~np.asarray(has_same_side_limit, dtype=bool)
+        )
+        reentry_price = liquidation + (entry - liquidation) * reentry_fraction
+        reentry_amount = notional * reentry_multiplier / mark
+
+    actions = []
+    # Only positions with something to do ever reach Python again
+    for i in np.flatnonzero(drop | move | high_water | reenter):
+        symbol = positions[i]['symbol']
+        if high_water[i]:
+            actions.append(Action('high_water', symbol, sides[i], float(hwm[i]), None))
+        if drop[i] and has_state[i]:
+            actions.append(Action('drop_state', symbol, sides[i], None, None))
+        elif move[i]:
+            actions.append(Action('move_stop', symbol, sides[i], float(new_stop[i]), float(contracts[i])))
+        if reenter[i]:
+            actions.append(Action('reenter', symbol, sides[i], float(reentry_price[i]), float(reentry_amount[i])))
+    return actions
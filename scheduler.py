@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Job:
+    # One recurring job on its own thread. Runs are due on a fixed grid
+    # (start + n * interval on the monotonic clock), so a slow run doesn't push
+    # every later run back. Runs that came due while the job was still busy are
+    # skipped and counted instead of piling up behind it.
+    def __init__(self, name, interval, fn, run_now=True):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.run_now = run_now
+        self.runs = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.thread = None
+
+    def loop(self, stop):
+        next_due = time.monotonic() + (0 if self.run_now else self.interval)
+        while not stop.is_set():
+            delay = next_due - time.monotonic()
+            if delay > 0 and stop.wait(delay):
+                return
+
+            started = time.monotonic()
+            try:
+                self.fn()
+            except Exception:
+                log.exception("❌ Job %s crashed, it runs again next tick:", self.name)
+            finished = time.monotonic()
+            self.runs += 1
+            self.last_duration = finished - started
+
+            next_due += self.interval
+            if finished > next_due:
+                missed = int((finished - next_due) // self.interval) + 1
+                self.skipped += missed
+                next_due += missed * self.interval
+                log.warning("⏱️ %s took %.1fs, skipped %d tick(s)", self.name, self.last_duration, missed)
+
+
+class TickScheduler:
+    # Each job gets its own thread so fast jobs (stop-loss checks) never wait
+    # behind slow ones (cleanup).
+    def __init__(self):
+        self.jobs = []
+        self.stop_event = threading.Event()
+
+    def every(self, interval, fn, name=None, run_now=True):
+        job = Job(name or fn.__name__, interval, fn, run_now)
+        self.jobs.append(job)
+        return job
+
+    def start(self):
+        for job in self.jobs:
+            job.thread = threading.Thread(target=job.loop, args=(self.stop_event,), name=job.name, daemon=True)
+            job.thread.start()
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self.stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            log.info("🛑 Stopping scheduler...")
+        finally:
+            self.stop()
+
+    def stop(self, timeout=30):
+        self.stop_event.set()
+        for job in self.jobs:
+            if job.thread is not None and job.thread is not threading.current_thread():
+                job.thread.join(timeout)
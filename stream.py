@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Feed events are plain dicts so any transport can produce them:
+#   {'type': 'position', 'symbol': ..., 'data': <ccxt position>}
+#   {'type': 'mark',     'symbol': ..., 'price': <float>}
+#   {'type': 'order',    'symbol': ..., 'data': <ccxt order>}
+# A transport's run(emit, stop) pushes events through emit() until stop is set.
+
+
+class ReplayTransport:
+    # Plays back a recorded feed, one JSON event per line. With speed > 0 the
+    # gaps between event 'ts' values (ms) are replayed, divided by speed.
+    def __init__(self, path, speed=0):
+        self.path = path
+        self.speed = speed
+
+    def run(self, emit, stop):
+        last_ts = None
+        with open(self.path, "r") as f:
+            for line in f:
+                if stop.is_set():
+                    return
+                line = line.strip()
+                if not line:
+                    continue
+                event = json.loads(line)
+                ts = event.get('ts')
+                if self.speed > 0 and ts is not None and last_ts is not None and ts > last_ts:
+                    time.sleep((ts - last_ts) / 1000.0 / self.speed)
+                last_ts = ts if ts is not None else last_ts
+                emit(event)
+
+
+class SocketTransport:
+    # Reads JSON-lines events from a TCP server, e.g. a local stub that
+    # replays a recorded session. Reconnects until stopped.
+    def __init__(self, host, port, reconnect_delay=2):
+        self.host = host
+        self.port = int(port)
+        self.reconnect_delay = reconnect_delay
+
+    def run(self, emit, stop):
+        while not stop.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=5) as sock:
+                    sock.settimeout(1)
+                    buffer = b""
+                    while not stop.is_set():
+                        try:
+                            chunk = sock.recv(65536)
+                        except socket.timeout:
+                            continue
+                        if not chunk:
+                            break
+                        buffer += chunk
+                        while b"\n" in buffer:
+                            line, buffer = buffer.split(b"\n", 1)
+                            if line.strip():
+                                emit(json.loads(line))
+            except OSError as e:
+                log.warning("⚠️ Feed connection to %s:%s failed: %s", self.host, self.port, e)
+            if not stop.is_set():
+                stop.wait(self.reconnect_delay)
+
+
+class CcxtProTransport:
+    # Live Phemex feed over ccxt.pro websockets. Phemex has no position
+    # stream, so positions are re-read over REST every position_refresh
+    # seconds and straight after any of our orders fills.
+    def __init__(self, config, symbols, position_refresh=30):
+        self.config = config
+        self.symbols = list(symbols)
+        self.position_refresh = position_refresh
+
+    def run(self, emit, stop):
+        # Websockets drop; keep reconnecting until we're told to stop
+        while not stop.is_set():
+            try:
+                asyncio.run(self._main(emit, stop))
+            except Exception as e:
+                log.warning("⚠️ Phemex feed dropped: %s — reconnecting", e)
+                stop.wait(5)
+
+    async def _main(self, emit, stop):
+        import ccxt.pro as ccxtpro
+
+        exchange = ccxtpro.phemex(dict(self.config))
+        refresh = asyncio.Event()
+        try:
+            await exchange.load_markets()
+            tasks = [
+                asyncio.create_task(self._watch_positions(exchange, emit, refresh)),
+                asyncio.create_task(self._watch_orders(exchange, emit, refresh)),
+            ]
+            if self.symbols:
+                tasks.append(asyncio.create_task(self._watch_marks(exchange, emit)))
+            while not stop.is_set():
+                await asyncio.sleep(0.5)
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+            for task in tasks:
+                task.cancel()
+        finally:
+            await exchange.close()
+
+    async def _watch_positions(self, exchange, emit, refresh):
+        while True:
+            positions = await exchange.fetch_positions(self.symbols or None)
+            for p in positions:
+                emit({'type': 'position', 'symbol': p['symbol'], 'data': p})
+            refresh.clear()
+            try:
+                await asyncio.wait_for(refresh.wait(), timeout=self.position_refresh)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _watch_orders(self, exchange, emit, refresh):
+        while True:
+            orders = await exchange.watch_orders(None, None, None, {'settle': 'USDT'})
+            for o in orders:
+                emit({'type': 'order', 'symbol': o['symbol'], 'data': o})
+                if o.get('filled'):
+                    refresh.set()
+
+    async def _watch_marks(self, exchange, emit):
+        while True:
+            tickers = await exchange.watch_tickers(self.symbols)
+            for symbol, ticker in tickers.items():
+                price = ticker.get('markPrice') or ticker.get('last')
+                if price:
+                    emit({'type': 'mark', 'symbol': symbol, 'price': float(price)})
+
+
+class StreamEngine:
+    # Keeps positions, mark prices and open orders current from a transport and
+    # calls on_change(positions, orders_by_symbol) with only the positions whose
+    # state moved since they were last handled. on_mark(symbol, price), if
+    # given, hears every new mark of a symbol we hold straight away, without
+    # waiting for min_interval; on_order(order) hears every order update.
+    def __init__(self, transport, on_change, min_interval=1.0, on_mark=None, on_order=None):
+        self.transport = transport
+        self.on_change = on_change
+        self.on_mark = on_mark
+        self.on_order = on_order
+        self.min_interval = min_interval
+        self.positions = {}
+        self.marks = {}
+        self.orders = {}
+        # When each symbol's positions were last heard of; marks don't count
+        self.seen = {}
+        self.dirty = set()
+        self.last_run = {}
+        self.events = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def seed(self, positions, orders=(), order_symbols=()):
+        # order_symbols lists the symbols whose open orders were fully fetched,
+        # so an empty book there means "no orders" rather than "unknown"
+        for symbol in order_symbols:
+            self.orders.setdefault(symbol, {})
+        for p in positions:
+            self.apply({'type': 'position', 'symbol': p['symbol'], 'data': p})
+        for o in orders:
+            self.apply({'type': 'order', 'symbol': o['symbol'], 'data': o})
+
+    def apply(self, event):
+        kind = event.get('type')
+        symbol = event.get('symbol')
+        if not symbol:
+            return
+
+        if kind == 'mark':
+            price = float(event['price'])
+            if self.marks.get(symbol) != price:
+                self.marks[symbol] = price
+                if symbol in self.positions:
+                    self.dirty.add(symbol)
+                    if self.on_mark is not None:
+                        try:
+                            self.on_mark(symbol, price)
+                        except Exception:
+                            log.exception("❌ Error handling mark of %s:", symbol)
+
+        elif kind == 'position':
+            # Hedge-mode accounts can hold both sides of a symbol at once
+            data = event['data']
+            side = (data.get('side') or '').lower()
+            contracts = float(data.get('contracts') or 0)
+            sides = self.positions.get(symbol, {})
+            self.seen[symbol] = time.time()
+            if data.get('markPrice'):
+                self.marks[symbol] = float(data['markPrice'])
+            if contracts <= 0:
+                # Closed: the cleanup job takes care of its trailing state. A
+                # flat one-way position has no real side (ccxt calls Phemex's
+                # "None" short), so only a named hedge leg closes just one side
+                leg = ((data.get('info') or {}).get('posSide') or '').lower()
+                for closed in ([leg] if leg in ('long', 'short') else list(sides)):
+                    sides.pop(closed, None)
+                if not sides:
+                    self.positions.pop(symbol, None)
+                    self.dirty.discard(symbol)
+                return
+            old = sides.get(side)
+            self.positions.setdefault(symbol, {})[side] = data
+            if old is None or any(
+                old.get(k) != data.get(k) for k in ('contracts', 'entryPrice', 'liquidationPrice', 'leverage')
+            ):
+                self.dirty.add(symbol)
+
+        elif kind == 'order':
+            data = event['data']
+            if self.on_order is not None:
+                try:
+                    self.on_order(data)
+                except Exception:
+                    log.exception("❌ Error handling order %s on %s:", data.get('id'), symbol)
+            book = self.orders.get(symbol)
+            if book is None:
+                # Updates alone can't tell us what else is resting on this symbol
+                return
+            if data.get('status') in (None, 'open'):
+                book[data['id']] = data
+            else:
+                book.pop(data['id'], None)
+            if symbol in self.positions:
+                self.dirty.add(symbol)
+
+    def post(self, event):
+        # An event from outside the feed (e.g. our own order results), applied
+        # on the engine's thread along with the feed's
+        self.events.put(event)
+
+    def symbol_positions(self, symbol):
+        # Copies with the freshest mark price folded in
+        mark = self.marks.get(symbol)
+        result = []
+        for pos in self.positions.get(symbol, {}).values():
+            pos = dict(pos)
+            if mark is not None:
+                pos['markPrice'] = mark
+            result.append(pos)
+        return result
+
+    def load_orders(self, symbol, orders):
+        self.orders[symbol] = {o['id']: o for o in orders}
+
+    def open_orders(self, symbol):
+        # None when we never saw this symbol's full order book
+        if symbol not in self.orders:
+            return None
+        return list(self.orders[symbol].values())
+
+    def take_due(self):
+        now = time.monotonic()
+        due = [s for s in self.dirty if now - self.last_run.get(s, 0) >= self.min_interval]
+        for symbol in due:
+            self.dirty.discard(symbol)
+            self.last_run[symbol] = now
+        return due
+
+    def start(self):
+        def feed():
+            try:
+                self.transport.run(self.events.put, self.stop_event)
+            except Exception:
+                log.exception("❌ Feed transport crashed:")
+            finally:
+                self.events.put(None)
+
+        thread = threading.Thread(target=feed, name="feed", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        self.start()
+        finished = False
+        while not self.stop_event.is_set():
+            # Drain everything that arrived so a burst of marks costs one pass
+            try:
+                event = self.events.get(timeout=self.min_interval)
+                while True:
+                    if event is None:
+                        finished = True
+                    else:
+                        self.apply(event)
+                    event = self.events.get_nowait()
+            except queue.Empty:
+                pass
+
+            due = [s for s in self.take_due() if s in self.positions]
+            if due:
+                changed = [pos for symbol in due for pos in self.symbol_positions(symbol)]
+                try:
+                    self.on_change(changed, {s: self.open_orders(s) for s in due})
+                except Exception:
+                    log.exception("❌ Error handling feed update:")
+            elif finished and not self.dirty:
+                return
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,51 @@
+import math
+
+# Continuous trailing: the stop follows the best mark a position has seen (its
+# high-water mark) at a fixed distance, instead of jumping in breath steps.
+#   percent - distance is a fraction of the high-water mark
+#   atr     - distance is a multiple of the symbol's ATR
+#   fixed   - distance is in price units
+TRAIL_MODES = ('percent', 'atr', 'fixed')
+
+
+def trail_distance(mode, distance, hwm, atr=None):
+    if mode == 'percent':
+        return hwm * distance
+    if mode == 'atr':
+        return atr * distance if atr else None
+    if mode == 'fixed':
+        return distance
+    raise ValueError(f"Unknown trailing mode {mode!r}, expected one of {', '.join(TRAIL_MODES)}")
+
+
+def high_water_mark(side, hwm, mark_price):
+    if hwm is None:
+        return mark_price
+    return max(hwm, mark_price) if side == 'long' else min(hwm, mark_price)
+
+
+def round_stop(side, price, tick_size):
+    # Onto the tick grid, on the side that leaves the position a little more room
+    if not tick_size:
+        return price
+    ticks = price / tick_size
+    # A hair of slack so prices already on the grid aren't pushed a tick away
+    ticks = math.floor(ticks + 1e-9) if side == 'long' else math.ceil(ticks - 1e-9)
+    return round(ticks * tick_size, 12)
+
+
+def ratchet(side, entry_price, mark_price, hwm, current_stop, mode, distance, tick_size=None, min_ticks=1, atr=None):
+    # The stop the high-water mark calls for, or None when there is nothing to
+    # send: it wouldn't lock in profit yet, the mark is already through it, or
+    # it doesn't beat the current stop by min_ticks ticks. Stops only ever
+    # move in the position's favour.
+    gap = trail_distance(mode, distance, hwm, atr)
+    if gap is None:
+        return None
+    stop = round_stop(side, hwm - gap if side == 'long' else hwm + gap, tick_size)
+    sign = 1 if side == 'long' else -1
+    if sign * (stop - entry_price) <= 0 or sign * (mark_price - stop) <= 0:
+        return None
+    if current_stop is not None and sign * (stop - current_stop) < min_ticks * (tick_size or 0) + 1e-12:
+        return None
+    return stop
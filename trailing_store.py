@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TrailingStore:
+    # Trailing state for every open position, kept in memory and keyed by
+    # (symbol, side) where side is the position side ('long' / 'short').
+    # Changes are only marked dirty; flush() writes them all in a single
+    # SQLite transaction, so a crash mid-write leaves the last flush intact.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = {}
+        self.dirty = set()
+        self.touched = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS trailing ("
+            " symbol TEXT NOT NULL, side TEXT NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (symbol, side))"
+        )
+        for symbol, side, data in self.conn.execute("SELECT symbol, side, data FROM trailing"):
+            self.data[(symbol, side)] = json.loads(data)
+
+    def get(self, symbol, side):
+        with self.lock:
+            data = self.data.get((symbol, side))
+            # Callers mutate what they get back before saving it
+            return dict(data) if data is not None else None
+
+    def set(self, symbol, side, data):
+        with self.lock:
+            self.data[(symbol, side)] = dict(data)
+            self.dirty.add((symbol, side))
+            self.touched[(symbol, side)] = time.monotonic()
+
+    def touched_since(self, symbol, side, since):
+        # Lets a slow reader skip entries written after it looked at the exchange
+        with self.lock:
+            return self.touched.get((symbol, side), 0) >= since
+
+    def delete(self, symbol, side=None):
+        with self.lock:
+            keys = [(symbol, side)] if side else [(symbol, 'long'), (symbol, 'short')]
+            deleted = False
+            for key in keys:
+                self.touched.pop(key, None)
+                if self.data.pop(key, None) is not None:
+                    self.dirty.add(key)
+                    deleted = True
+            return deleted
+
+    def clear(self):
+        with self.lock:
+            self.dirty.update(self.data)
+            self.data.clear()
+            self.touched.clear()
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return 0
+            writes = [(key, self.data.get(key)) for key in self.dirty]
+            self.dirty.clear()
+            try:
+                self.conn.execute("BEGIN")
+                for (symbol, side), data in writes:
+                    if data is None:
+                        self.conn.execute("DELETE FROM trailing WHERE symbol = ? AND side = ?", (symbol, side))
+                    else:
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO trailing (symbol, side, data) VALUES (?, ?, ?)",
+                            (symbol, side, json.dumps(data)),
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # Nothing was written, try the same keys again next flush
+                self.dirty.update(key for key, _ in writes)
+                raise
+            return len(writes)
+
+    def import_json_folder(self, folder, filename_to_symbol):
+        # One-off migration from the old trailProfit/buy|sell/<symbol>.json layout
+        imported = []
+        for subfolder, side in (('buy', 'long'), ('sell', 'short')):
+            path = os.path.join(folder, subfolder)
+            if not os.path.isdir(path):
+                continue
+            for fname in os.listdir(path):
+                symbol = filename_to_symbol(fname)
+                if not symbol:
+                    continue
+                filepath = os.path.join(path, fname)
+                try:
+                    with open(filepath, "r") as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    log.warning("⚠️ Skipping unreadable trailing file %s/%s: %s", subfolder, fname, e)
+                    continue
+                with self.lock:
+                    # Anything already in the store is newer than the old files
+                    if (symbol, side) not in self.data:
+                        self.set(symbol, side, data)
+                imported.append(filepath)
+        self.flush()
+        return imported
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,47 @@
+import threading
+
+from collections import namedtuple
+
+# A stop we watch ourselves instead of resting it on the exchange
+Trigger = namedtuple('Trigger', ['symbol', 'side', 'stop_price', 'contracts'])
+
+
+def breached(side, stop_price, mark):
+    return mark <= stop_price if side == 'long' else mark >= stop_price
+
+
+class TriggerEngine:
+    # Trailing stops kept in memory, keyed by (symbol, side) like the trailing
+    # state. check() is called with every mark price we see; a breached
+    # trigger is taken out as it is returned, so it fires exactly once even if
+    # marks arrive from several threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levels = {}
+
+    def arm(self, symbol, side, stop_price, contracts):
+        with self.lock:
+            self.levels[(symbol, side)] = Trigger(symbol, side, stop_price, contracts)
+
+    def disarm(self, symbol, side=None):
+        with self.lock:
+            for key in ([(symbol, side)] if side else [(symbol, 'long'), (symbol, 'short')]):
+                self.levels.pop(key, None)
+
+    def get(self, symbol, side):
+        with self.lock:
+            return self.levels.get((symbol, side))
+
+    def check(self, symbol, mark, side=None):
+        fired = []
+        with self.lock:
+            for key in ([(symbol, side)] if side else [(symbol, 'long'), (symbol, 'short')]):
+                trigger = self.levels.get(key)
+                if trigger is not None and breached(trigger.side, trigger.stop_price, mark):
+                    del self.levels[key]
+                    fired.append(trigger)
+        return fired
+
+    def __len__(self):
+        with self.lock:
+            return len(self.levels)